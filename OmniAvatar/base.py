@@ -2,6 +2,7 @@ import torch
 import numpy as np
 from PIL import Image
 from torchvision.transforms import GaussianBlur
+from .vram_management import ResidencyManager
 
 
 
@@ -15,6 +16,7 @@ class BasePipeline(torch.nn.Module):
         self.width_division_factor = width_division_factor
         self.cpu_offload = False
         self.model_names = []
+        self.residency = ResidencyManager(device)
 
 
     def check_resize_height_width(self, height, width):
@@ -96,29 +98,8 @@ class BasePipeline(torch.nn.Module):
         # only load models to device if cpu_offload is enabled
         if not self.cpu_offload:
             return
-        # offload the unneeded models to cpu
-        for model_name in self.model_names:
-            if model_name not in loadmodel_names:
-                model = getattr(self, model_name)
-                if model is not None:
-                    if hasattr(model, "vram_management_enabled") and model.vram_management_enabled:
-                        for module in model.modules():
-                            if hasattr(module, "offload"):
-                                module.offload()
-                    else:
-                        model.cpu()
-        # load the needed models to device
-        for model_name in loadmodel_names:
-            model = getattr(self, model_name)
-            if model is not None:
-                if hasattr(model, "vram_management_enabled") and model.vram_management_enabled:
-                    for module in model.modules():
-                        if hasattr(module, "onload"):
-                            module.onload()
-                else:
-                    model.to(self.device)
-        # fresh the cuda cache
-        torch.cuda.empty_cache()
+        # offload the unneeded models to cpu and load the needed ones, skipping models that are already in place
+        self.residency.load({model_name: getattr(self, model_name) for model_name in self.model_names}, loadmodel_names)
 
     
     def generate_noise(self, shape, seed=None, device="cpu", dtype=torch.float16):
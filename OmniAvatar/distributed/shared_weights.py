@@ -0,0 +1,53 @@
+import os, shutil, fcntl
+from ..models.compiled_checkpoint import CompiledCheckpoint
+
+# Open lock files of the stores this process writes or maps, kept for the lifetime of the process
+held_store_locks = {}
+
+
+class SharedWeightStore(CompiledCheckpoint):
+    # Node-local compiled checkpoint in shared memory (/dev/shm by default).
+    # Local rank 0 writes it once; every local rank then maps the same file and uses the mapped tensors as its host
+    # weights, so host memory does not grow with the number of ranks and the other ranks never read the checkpoints.
+    # The mappings are private (copy-on-write): the ranks share the pages of the file as long as nobody writes to them,
+    # and a rank that does gets its own copy of the page instead of changing the weights of the others.
+    # Every process using a store holds a shared lock on its lock file, a store is only removed when nobody does.
+    def __init__(self, root, key):
+        super().__init__(os.path.join(root, key))
+        self.root = root
+        self.lock_path = os.path.join(self.path, "in_use.lock")
+
+    def hold(self):
+        if self.lock_path not in held_store_locks:
+            os.makedirs(self.path, exist_ok=True)
+            lock_file = open(self.lock_path, "a")
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            held_store_locks[self.lock_path] = lock_file
+
+    def remove_stale(self):
+        # Stores of other keys (older checkpoints or loading options) that no process uses any more
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            lock_path = os.path.join(path, "in_use.lock")
+            # Without a lock file it is not a store, or one whose users cannot be known
+            if path == self.path or not os.path.exists(lock_path):
+                continue
+            with open(lock_path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                print(f"Removing stale shared weight store {path}")
+                shutil.rmtree(path, ignore_errors=True)
+
+    def save(self, models, key="", lora_merged=False):
+        # The store is held before it is written, so that it is never removed half-written
+        self.hold()
+        self.remove_stale()
+        super().save(models, key, lora_merged)
+
+    def load_weights(self, models, shared=False):
+        self.hold()
+        super().load_weights(models, shared=shared)
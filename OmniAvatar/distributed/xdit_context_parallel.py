@@ -6,6 +6,7 @@ from xfuser.core.distributed import (get_sequence_parallel_rank,
                                      get_sp_group)
 from xfuser.core.long_ctx_attention import xFuserLongContextAttention
 from yunchang import LongContextAttention
+from ..models.wan_video_dit import rope_apply as local_rope_apply
 
 def sinusoidal_embedding_1d(dim, position):
     sinusoid = torch.outer(position.type(torch.float64), torch.pow(
@@ -13,35 +14,32 @@ def sinusoidal_embedding_1d(dim, position):
     x = torch.cat([torch.cos(sinusoid), torch.sin(sinusoid)], dim=1)
     return x.to(position.dtype)
 
-def pad_freqs(original_tensor, target_len):
+def pad_freqs(original_tensor, target_len, value=1):
     seq_len, s1, s2 = original_tensor.shape
     pad_size = target_len - seq_len
-    padding_tensor = torch.ones(
-        pad_size,
-        s1,
-        s2,
+    padding_tensor = torch.full(
+        (pad_size, s1, s2),
+        value,
         dtype=original_tensor.dtype,
         device=original_tensor.device)
     padded_tensor = torch.cat([original_tensor, padding_tensor], dim=0)
     return padded_tensor
     
 def rope_apply(x, freqs, num_heads):
-    x = rearrange(x, "b s (n d) -> b s n d", n=num_heads)
     s_per_rank = x.shape[1]
     s_per_rank = get_sp_group().broadcast_object_list([s_per_rank], src=0)[0] # TODO: the size should be devided by sp_size
-    
-    x_out = torch.view_as_complex(x.to(torch.float64).reshape(
-        x.shape[0], x.shape[1], x.shape[2], -1, 2))
 
+    cos, sin = freqs
     sp_size = get_sequence_parallel_world_size()
     sp_rank = get_sequence_parallel_rank()
-    if freqs.shape[0] % sp_size != 0 and freqs.shape[0] // sp_size == s_per_rank:
+    if cos.shape[0] % sp_size != 0 and cos.shape[0] // sp_size == s_per_rank:
         s_per_rank = s_per_rank + 1
-    freqs = pad_freqs(freqs, s_per_rank * sp_size)
-    freqs_rank = freqs[(sp_rank * s_per_rank):((sp_rank + 1) * s_per_rank), :, :]
-    freqs_rank = freqs_rank[:x.shape[1]]
-    x_out = torch.view_as_real(x_out * freqs_rank).flatten(2)
-    return x_out.to(x.dtype)
+    # padding tokens get the identity rotation
+    cos = pad_freqs(cos, s_per_rank * sp_size, value=1)
+    sin = pad_freqs(sin, s_per_rank * sp_size, value=0)
+    cos_rank = cos[(sp_rank * s_per_rank):((sp_rank + 1) * s_per_rank), :, :][:x.shape[1]]
+    sin_rank = sin[(sp_rank * s_per_rank):((sp_rank + 1) * s_per_rank), :, :][:x.shape[1]]
+    return local_rope_apply(x, (cos_rank, sin_rank), num_heads)
 
 def usp_dit_forward(self,
             x: torch.Tensor,
@@ -65,11 +63,7 @@ def usp_dit_forward(self,
     
     x, (f, h, w) = self.patchify(x)
     
-    freqs = torch.cat([
-        self.freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-        self.freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-        self.freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-    ], dim=-1).reshape(f * h * w, 1, -1).to(x.device)
+    freqs = self.rope_cache.get(f, h, w, x.device, x.dtype)
 
     def create_custom_forward(module):
         def custom_forward(*inputs):
@@ -102,10 +96,10 @@ def usp_dit_forward(self,
     x = self.head(x, t)
 
     # Context Parallel
-    if x.shape[1] * get_sequence_parallel_world_size() < freqs.shape[0]:
+    if x.shape[1] * get_sequence_parallel_world_size() < freqs[0].shape[0]:
         x = torch.cat([x, x[:, -1:]], 1) # TODO: this may cause some bias, the best way is to use sp_size=2
     x = get_sp_group().all_gather(x, dim=1) # TODO: the size should be devided by sp_size
-    x = x[:, :freqs.shape[0]]
+    x = x[:, :freqs[0].shape[0]]
 
     # unpatchify
     x = self.unpatchify(x, (f, h, w))
@@ -0,0 +1,84 @@
+import os, json, hashlib, importlib
+from safetensors.torch import save_file
+from ..utils.io_utils import init_weights_on_device, map_safetensors
+
+
+def checkpoint_key(paths, *extra):
+    # Identifies the loaded weights by the checkpoint files (path, size, mtime) and the loading options
+    hasher = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        hasher.update(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    for value in extra:
+        hasher.update(f"{value}\n".encode())
+    return hasher.hexdigest()[:16]
+
+
+def inference_checkpoint_key(args, dtype):
+    return checkpoint_key(
+        [*args.dit_path.split(","), args.text_encoder_path, args.vae_path, f"{args.exp_path}/pytorch_model.pt"],
+        dtype, args.train_architecture,
+        getattr(args, "lora_rank", None), getattr(args, "lora_alpha", None), getattr(args, "lora_target_modules", None),
+    )
+
+
+class CompiledCheckpoint:
+    # The pipeline models as they are after loading (converted, cast, OmniAvatar weights or LoRA applied), in one directory:
+    # weights.safetensors holds every model under its model name prefix, manifest.json the model classes, init kwargs
+    # and source paths. Loading it skips detection, conversion and casting: the models are built on the meta device
+    # and their parameters become views of the mapped file.
+    def __init__(self, path):
+        self.path = path
+        self.weights_path = os.path.join(path, "weights.safetensors")
+        self.manifest_path = os.path.join(path, "manifest.json")
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def manifest(self):
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def up_to_date(self, key):
+        return self.exists() and self.manifest()["key"] == key
+
+    def save(self, models, key="", lora_merged=False):
+        # models: {model_name: (model_path, model)}
+        os.makedirs(self.path, exist_ok=True)
+        state_dict, manifest = {}, {"key": key, "lora_merged": lora_merged, "models": {}}
+        for model_name, (model_path, model) in models.items():
+            for name, tensor in model.state_dict().items():
+                state_dict[f"{model_name}.{name}"] = tensor.detach().cpu().contiguous()
+            manifest["models"][model_name] = {
+                "class": f"{type(model).__module__}:{type(model).__qualname__}",
+                "kwargs": getattr(model, "init_kwargs", {}),
+                "path": model_path,
+            }
+        save_file(state_dict, f"{self.weights_path}.tmp")
+        os.replace(f"{self.weights_path}.tmp", self.weights_path)
+        # The manifest is written last, it marks the checkpoint as complete
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def build_models(self, model_names=None):
+        # [(model_name, model_path, model)] with the parameters on the meta device
+        models = []
+        for model_name, info in self.manifest()["models"].items():
+            if model_names is not None and model_name not in model_names:
+                continue
+            module_name, class_name = info["class"].split(":")
+            model_class = getattr(importlib.import_module(module_name), class_name)
+            with init_weights_on_device():
+                model = model_class(**info["kwargs"])
+            model.init_kwargs = info["kwargs"]
+            models.append((model_name, info["path"], model.eval()))
+        return models
+
+    def load_weights(self, models, shared=False):
+        # models: {model_name: model}, the parameters are replaced by views of the mapped file
+        # (shared=True maps the file itself, e.g. in /dev/shm, instead of a private copy-on-write mapping)
+        state_dict = map_safetensors(self.weights_path, shared=shared)
+        for model_name, model in models.items():
+            prefix = f"{model_name}."
+            model.load_state_dict({name[len(prefix):]: tensor for name, tensor in state_dict.items() if name.startswith(prefix)}, assign=True, strict=True)
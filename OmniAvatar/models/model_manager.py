@@ -1,8 +1,11 @@
-import os, torch, json, importlib
+import os, torch, json, importlib, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import List
 import torch.nn as nn
 from ..configs.model_config import model_loader_configs, huggingface_model_loader_configs
-from ..utils.io_utils import load_state_dict, init_weights_on_device, hash_state_dict_keys, split_state_dict_with_prefix, smart_load_weights
+from .compiled_checkpoint import CompiledCheckpoint
+from ..utils.io_utils import load_state_dict, load_state_dict_metadata, read_into_page_cache, init_weights_on_device, hash_state_dict_keys, split_state_dict_with_prefix, smart_load_weights, materialize_weights
 
 
 def load_model_from_single_file(state_dict, model_names, model_classes, model_resource, torch_dtype, device, infer):
@@ -22,6 +25,7 @@ def load_model_from_single_file(state_dict, model_names, model_classes, model_re
         torch_dtype = torch.float32 if extra_kwargs.get("upcast_to_float32", False) else torch_dtype
         with init_weights_on_device():
             model = model_class(**extra_kwargs)
+        model.init_kwargs = extra_kwargs # lets the shared weight store rebuild the model without its checkpoint
         if hasattr(model, "eval"):
             model = model.eval()
         if not infer: # 训练才初始化
@@ -31,11 +35,11 @@ def load_model_from_single_file(state_dict, model_names, model_classes, model_re
                     nn.init.xavier_uniform_(param, gain=0.05)
                 else:
                     nn.init.zeros_(param)
+            model, _, _ = smart_load_weights(model, model_state_dict)
+            # model.load_state_dict(model_state_dict, assign=True, strict=False)
+            model = model.to(dtype=torch_dtype, device=device)
         else:
-            model = model.to_empty(device=device)
-        model, _, _ = smart_load_weights(model, model_state_dict)
-        # model.load_state_dict(model_state_dict, assign=True, strict=False)
-        model = model.to(dtype=torch_dtype, device=device)
+            model = materialize_weights(model, model_state_dict, torch_dtype, device)
         loaded_model_names.append(model_name)
         loaded_models.append(model)
     return loaded_model_names, loaded_models
@@ -275,6 +279,28 @@ class ModelDetectorFromPatchedSingleFile:
 
 
 
+class ByteSemaphore:
+    # Admits requests while their total size stays under max_bytes (None: unbounded); a request larger than
+    # max_bytes still runs, alone
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, num_bytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.max_bytes is None or self.num_bytes == 0 or self.num_bytes + num_bytes <= self.max_bytes)
+            self.num_bytes += num_bytes
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.num_bytes -= num_bytes
+                self.condition.notify_all()
+
+
+
 class ModelManager:
     def __init__(
         self,
@@ -334,36 +360,84 @@ class ModelManager:
 
     def load_model(self, file_path, model_names=None, device=None, torch_dtype=None):
         print(f"Loading models from: {file_path}")
+        model_names, models = self.detect_and_load_model(file_path, model_names, device, torch_dtype)
+        self.add_models(file_path, model_names, models)
+
+
+    def add_models(self, file_path, model_names, models):
+        for model_name, model in zip(model_names, models):
+            self.model.append(model)
+            self.model_path.append(file_path)
+            self.model_name.append(model_name)
+
+
+    def detect_and_load_model(self, file_path, model_names=None, device=None, torch_dtype=None):
         if device is None: device = self.device
         if torch_dtype is None: torch_dtype = self.torch_dtype
+        # Detect the model type from the keys and shapes only, the tensors are read once a detector matches
         if isinstance(file_path, list):
             state_dict = {}
             for path in file_path:
-                state_dict.update(load_state_dict(path))
+                state_dict.update(load_state_dict_metadata(path))
         elif os.path.isfile(file_path):
-            state_dict = load_state_dict(file_path)
+            state_dict = load_state_dict_metadata(file_path)
         else:
             state_dict = None
         for model_detector in self.model_detector:
             if model_detector.match(file_path, state_dict):
+                # Mapped tensors, only read when they are written into the model
+                if isinstance(file_path, list):
+                    state_dict = {}
+                    for path in file_path:
+                        state_dict.update(load_state_dict(path, mmap=True))
+                elif state_dict is not None:
+                    state_dict = load_state_dict(file_path, mmap=True)
                 model_names, models = model_detector.load(
                     file_path, state_dict,
                     device=device, torch_dtype=torch_dtype,
                     allowed_model_names=model_names, model_manager=self, infer=self.infer
                 )
-                for model_name, model in zip(model_names, models):
-                    self.model.append(model)
-                    self.model_path.append(file_path)
-                    self.model_name.append(model_name)
                 print(f"    The following models are loaded: {model_names}.")
-                break
-        else:
-            print(f"    We cannot detect the model type. No models are loaded.")
+                return model_names, models
+        print(f"    We cannot detect the model type. No models are loaded.")
+        return [], []
         
 
-    def load_models(self, file_path_list, model_names=None, device=None, torch_dtype=None):
-        for file_path in file_path_list:
-            self.load_model(file_path, model_names, device=device, torch_dtype=torch_dtype)
+    def load_models(self, file_path_list, model_names=None, device=None, torch_dtype=None, num_workers=1, max_inflight_bytes=None):
+        if num_workers <= 1:
+            for file_path in file_path_list:
+                self.load_model(file_path, model_names, device=device, torch_dtype=torch_dtype)
+            return
+        # Components (and the shards of a component) are read concurrently; max_inflight_bytes bounds
+        # the total size of the components being loaded at once
+        budget = ByteSemaphore(max_inflight_bytes)
+        def load(file_path):
+            files = [path for path in (file_path if isinstance(file_path, list) else [file_path]) if os.path.isfile(path)]
+            with budget.reserve(sum(os.path.getsize(path) for path in files)):
+                start = time.perf_counter()
+                print(f"Loading models from: {file_path}")
+                with ThreadPoolExecutor(num_workers) as reader:
+                    list(reader.map(read_into_page_cache, files))
+                loaded_model_names, models = self.detect_and_load_model(file_path, model_names, device, torch_dtype)
+                return loaded_model_names, models, time.perf_counter() - start
+        with ThreadPoolExecutor(num_workers) as executor:
+            results = list(executor.map(load, file_path_list))
+        # Added in the order of file_path_list, as with sequential loading
+        for file_path, (loaded_model_names, models, seconds) in zip(file_path_list, results):
+            self.add_models(file_path, loaded_model_names, models)
+            print(f"    {loaded_model_names} loaded in {seconds:.1f}s")
+
+
+    def load_compiled_checkpoint(self, compiled_checkpoint: CompiledCheckpoint, model_names=None, load_weights=True):
+        # Models written by scripts/compile_checkpoint.py; without load_weights they stay on the meta device
+        # until compiled_checkpoint.load_weights() is called (e.g. after injecting LoRA adapters)
+        print(f"Loading compiled checkpoint: {compiled_checkpoint.path}")
+        models = compiled_checkpoint.build_models(model_names)
+        if load_weights:
+            compiled_checkpoint.load_weights({model_name: model for model_name, _, model in models})
+        for model_name, model_path, model in models:
+            self.add_models(model_path, [model_name], [model])
+        print(f"    The following models are loaded: {[model_name for model_name, _, _ in models]}.")
 
     
     def fetch_model(self, model_name, file_path=None, require_model_path=False):
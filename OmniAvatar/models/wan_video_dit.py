@@ -91,12 +91,38 @@ def precompute_freqs_cis(dim: int, end: int = 1024, theta: float = 10000.0):
     return freqs_cis
 
 
+class RopeCache:
+    # Real-valued cos/sin tables of the 3d rope, built once per (f, h, w) grid on the computation device.
+    def __init__(self, freqs):
+        self.freqs = freqs
+        self.tables = {}
+
+    def get(self, f, h, w, device, dtype):
+        key = (f, h, w, torch.device(device), dtype)
+        if key not in self.tables:
+            fp32_key = (f, h, w, torch.device(device), torch.float32)
+            if fp32_key not in self.tables:
+                freqs = torch.cat([
+                    self.freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+                    self.freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+                    self.freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
+                ], dim=-1).reshape(f * h * w, 1, -1)
+                self.tables[fp32_key] = (freqs.real.float().to(device), freqs.imag.float().to(device))
+            cos, sin = self.tables[fp32_key]
+            self.tables[key] = (cos.to(dtype), sin.to(dtype))
+        return self.tables[key]
+
+    def clear(self):
+        self.tables = {}
+
+
 def rope_apply(x, freqs, num_heads):
-    x = rearrange(x, "b s (n d) -> b s n d", n=num_heads)
-    x_out = torch.view_as_complex(x.to(torch.float64).reshape(
-        x.shape[0], x.shape[1], x.shape[2], -1, 2))
-    x_out = torch.view_as_real(x_out * freqs).flatten(2)
-    return x_out.to(x.dtype)
+    # freqs: (cos, sin), each s, 1, d/2; rotates the (even, odd) channel pairs in the dtype of x
+    cos, sin = freqs
+    x = rearrange(x, "b s (n d two) -> b s n d two", n=num_heads, two=2)
+    x_real, x_imag = x.unbind(-1)
+    x_out = torch.stack([x_real * cos - x_imag * sin, x_real * sin + x_imag * cos], dim=-1)
+    return x_out.flatten(2)
 
 
 class RMSNorm(nn.Module):
@@ -170,24 +196,64 @@ class CrossAttention(nn.Module):
             
         self.attn = AttentionModule(self.num_heads)
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor):
+    def forward(self, x: torch.Tensor, y: torch.Tensor, context_cache=None):
         if self.has_image_input:
             img = y[:, :257]
             ctx = y[:, 257:]
         else:
             ctx = y
         q = self.norm_q(self.q(x))
-        k = self.norm_k(self.k(ctx))
-        v = self.v(ctx)
+        if context_cache is None:
+            k, v = self.norm_k(self.k(ctx)), self.v(ctx)
+        else:
+            k, v = context_cache.get((self, "kv"), lambda: (self.norm_k(self.k(ctx)), self.v(ctx)))
         x = self.attn(q, k, v)
         if self.has_image_input:
-            k_img = self.norm_k_img(self.k_img(img))
-            v_img = self.v_img(img)
+            if context_cache is None:
+                k_img, v_img = self.norm_k_img(self.k_img(img)), self.v_img(img)
+            else:
+                k_img, v_img = context_cache.get((self, "kv_img"), lambda: (self.norm_k_img(self.k_img(img)), self.v_img(img)))
             y = flash_attention(q, k_img, v_img, num_heads=self.num_heads)
             x = x + y
         return self.o(x)
 
 
+class ConditionCache:
+    # Tensors derived only from the conditioning inputs (text context, audio, reference image),
+    # computed on first use and reused for every denoising step that shares those inputs.
+    def __init__(self):
+        self.tensors = {}
+
+    def get(self, key, fn):
+        if key not in self.tensors:
+            self.tensors[key] = fn()
+        return self.tensors[key]
+
+    def clear(self):
+        self.tensors = {}
+
+
+class TimestepModulation(ConditionCache):
+    # Time embedding and per-block shift/scale/gate tables for every step of a schedule.
+    # The tables are built lazily inside the owning module's forward (so FSDP/vram management have the weights
+    # available) and the pipeline selects the current step through `index`.
+    def __init__(self, timesteps):
+        super().__init__()
+        self.timesteps = timesteps
+        self.index = 0
+
+    def step(self, key, fn):
+        return self.get(key, fn)[self.index]
+
+    @property
+    def t(self):
+        return self.tensors["t"][0]
+
+    @property
+    def t_mod(self):
+        return self.tensors["t"][1]
+
+
 class GateModule(nn.Module):
     def __init__(self,):
         super().__init__()
@@ -213,13 +279,18 @@ class DiTBlock(nn.Module):
         self.modulation = nn.Parameter(torch.randn(1, 6, dim) / dim**0.5)
         self.gate = GateModule()
 
-    def forward(self, x, context, t_mod, freqs):
+    def forward(self, x, context, t_mod, freqs, context_cache=None, timestep_modulation=None):
         # msa: multi-head self-attention  mlp: multi-layer perceptron
-        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
-            self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod).chunk(6, dim=1)
+        if timestep_modulation is None:
+            shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
+                self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod).chunk(6, dim=1)
+        else:
+            # steps, 6, 1, dim
+            shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = timestep_modulation.step(
+                self, lambda: (self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + timestep_modulation.t_mod).unsqueeze(2))
         input_x = modulate(self.norm1(x), shift_msa, scale_msa)
         x = self.gate(x, gate_msa, self.self_attn(input_x, freqs))
-        x = x + self.cross_attn(self.norm3(x), context)
+        x = x + self.cross_attn(self.norm3(x), context, context_cache)
         input_x = modulate(self.norm2(x), shift_mlp, scale_mlp)
         x = self.gate(x, gate_mlp, self.ffn(input_x))
         return x
@@ -249,8 +320,13 @@ class Head(nn.Module):
         self.head = nn.Linear(dim, out_dim * math.prod(patch_size))
         self.modulation = nn.Parameter(torch.randn(1, 2, dim) / dim**0.5)
 
-    def forward(self, x, t_mod):
-        shift, scale = (self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod).chunk(2, dim=1)
+    def forward(self, x, t_mod, timestep_modulation=None):
+        if timestep_modulation is None:
+            shift, scale = (self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod.unsqueeze(1)).chunk(2, dim=1)
+        else:
+            # steps, 2, 1, dim
+            shift, scale = timestep_modulation.step(
+                self, lambda: (self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + timestep_modulation.t.unsqueeze(1)).unsqueeze(2))
         x = (self.head(self.norm(x) * (1 + scale) + shift))
         return x
 
@@ -300,6 +376,7 @@ class WanModel(torch.nn.Module):
         self.head = Head(dim, out_dim, patch_size, eps)
         head_dim = dim // num_heads
         self.freqs = precompute_freqs_cis_3d(head_dim)
+        self.rope_cache = RopeCache(self.freqs)
 
         if has_image_input:
             self.img_emb = MLP(1280, dim)  # clip_feature_dim = 1280
@@ -329,6 +406,40 @@ class WanModel(torch.nn.Module):
             x=self.patch_size[0], y=self.patch_size[1], z=self.patch_size[2]
         )
 
+    def embed_timesteps(self, timestep: torch.Tensor):
+        t = self.time_embedding(
+            sinusoidal_embedding_1d(self.freq_dim, timestep))
+        t_mod = self.time_projection(t).unflatten(1, (6, self.dim))
+        return t, t_mod
+
+    def project_audio(self, audio_emb: torch.Tensor):
+        audio_emb = audio_emb.permute(0, 2, 1)[:, :, :, None, None]
+        audio_emb = torch.cat([audio_emb[:, :, :1].repeat(1, 1, 3, 1, 1), audio_emb], 2) # 1, 768, 44, 1, 1
+        audio_emb = self.audio_proj(audio_emb)
+
+        # b, num_audio_layers, f, 1, 1, c
+        return torch.stack([audio_cond_proj(audio_emb) for audio_cond_proj in self.audio_cond_projs], 1)
+
+    def embed_patches(self, x: torch.Tensor, y: torch.Tensor, image_cache: Optional[ConditionCache] = None):
+        if image_cache is None:
+            return self.patch_embedding(torch.cat([x, y], dim=1))
+        # The convolution is linear in its input channels: conv([x, y]) = conv(x; W_x) + conv(y; W_y) + b.
+        # y is constant within a chunk, so only the noisy latent channels are convolved at every step.
+        conv = getattr(self.patch_embedding, "module", self.patch_embedding) # unwrap vram management
+        weight = conv.weight.to(dtype=x.dtype, device=x.device)
+        y_emb = image_cache.get("y_emb", lambda: F.conv3d(
+            y.to(dtype=x.dtype), weight[:, x.shape[1]:], conv.bias.to(dtype=x.dtype, device=x.device), stride=conv.stride, padding=conv.padding))
+        return F.conv3d(x, weight[:, :x.shape[1]], stride=conv.stride, padding=conv.padding) + y_emb
+
+    def inject_audio(self, x: torch.Tensor, audio_emb: torch.Tensor, grid_size, audio_frame_ids: Optional[torch.Tensor] = None):
+        # Adds the per-frame audio vector to every token of that frame without materialising it on the token grid.
+        f, h, w = grid_size
+        audio_emb = audio_emb.flatten(1, 3) # b, f, c
+        if audio_frame_ids is None:
+            return (audio_emb.unsqueeze(2) + x.unflatten(1, (f, h * w))).flatten(1, 2)
+        # Sequence parallel: only gather the rank-local tokens, padding tokens get the appended zero frame
+        return F.pad(audio_emb, (0, 0, 0, 1))[:, audio_frame_ids] + x
+
     def forward(self,
                 x: torch.Tensor,
                 timestep: torch.Tensor,
@@ -339,30 +450,34 @@ class WanModel(torch.nn.Module):
                 audio_emb: Optional[torch.Tensor] = None,
                 use_gradient_checkpointing_offload: bool = False,
                 tea_cache = None,
+                context_cache: Optional[ConditionCache] = None,
+                timestep_modulation: Optional[TimestepModulation] = None,
+                audio_cache: Optional[ConditionCache] = None,
+                image_cache: Optional[ConditionCache] = None,
                 **kwargs,
                 ):
-        t = self.time_embedding(
-            sinusoidal_embedding_1d(self.freq_dim, timestep))
-        t_mod = self.time_projection(t).unflatten(1, (6, self.dim))
-        context = self.text_embedding(context)
-        lat_h, lat_w = x.shape[-2], x.shape[-1]
-
-        if audio_emb != None and self.use_audio: # TODO  cache
-            audio_emb = audio_emb.permute(0, 2, 1)[:, :, :, None, None]
-            audio_emb = torch.cat([audio_emb[:, :, :1].repeat(1, 1, 3, 1, 1), audio_emb], 2) # 1, 768, 44, 1, 1
-            audio_emb = self.audio_proj(audio_emb)
+        if timestep_modulation is None:
+            t, t_mod = self.embed_timesteps(timestep)
+        else:
+            # All steps of the schedule are embedded at once, blocks and head build their tables from these
+            timestep_modulation.get("t", lambda: self.embed_timesteps(timestep_modulation.timesteps.to(dtype=timestep.dtype, device=timestep.device)))
+            index = timestep_modulation.index
+            t, t_mod = timestep_modulation.t[index:index + 1], timestep_modulation.t_mod[index:index + 1]
+        if context_cache is None:
+            context = self.text_embedding(context)
+        else:
+            context = context_cache.get("context", lambda: self.text_embedding(context))
 
-            audio_emb = torch.concat([audio_cond_proj(audio_emb) for audio_cond_proj in self.audio_cond_projs], 0)
+        if audio_emb is not None and self.use_audio:
+            if audio_cache is None:
+                audio_emb = self.project_audio(audio_emb)
+            else:
+                audio_emb = audio_cache.get("audio_emb", lambda: self.project_audio(audio_emb))
 
-        x = torch.cat([x, y], dim=1)
-        x = self.patch_embedding(x)
+        x = self.embed_patches(x, y, image_cache)
         x, (f, h, w) = self.patchify(x)
         
-        freqs = torch.cat([
-            self.freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            self.freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            self.freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ], dim=-1).reshape(f * h * w, 1, -1).to(x.device)
+        freqs = self.rope_cache.get(f, h, w, x.device, x.dtype)
         
         def create_custom_forward(module):
             def custom_forward(*inputs):
@@ -385,22 +500,19 @@ class WanModel(torch.nn.Module):
                     pad_size = sp_size - ori_x_len % sp_size
                     x = torch.cat([x, torch.zeros_like(x[:, -1:]).repeat(1, pad_size, 1)], 1)
                 x = torch.chunk(x, sp_size, dim=1)[get_sequence_parallel_rank()]
+                # frame of every rank-local token, padding tokens point one past the last frame
+                token_ids = torch.arange(x.shape[1], device=x.device) + get_sequence_parallel_rank() * x.shape[1]
+                audio_frame_ids = (token_ids // (h * w)).clamp(max=f)
+            else:
+                audio_frame_ids = None
 
-            audio_emb = audio_emb.reshape(x.shape[0], audio_emb.shape[0] // x.shape[0], -1, *audio_emb.shape[2:])
-                
             for layer_i, block in enumerate(self.blocks):
                 # audio cond
-                if self.use_audio:
+                if self.use_audio and audio_emb is not None:
                     au_idx = None
                     if (layer_i <= len(self.blocks) // 2 and layer_i > 1): # < len(self.blocks) - 1:
                         au_idx = layer_i - 2
-                        audio_emb_tmp = audio_emb[:, au_idx].repeat(1, 1, lat_h // 2, lat_w // 2, 1) # 1, 11, 45, 25, 128
-                        audio_cond_tmp = self.patchify(audio_emb_tmp.permute(0, 4, 1, 2, 3))[0]
-                        if args.sp_size > 1:
-                            if pad_size > 0:    
-                                audio_cond_tmp = torch.cat([audio_cond_tmp, torch.zeros_like(audio_cond_tmp[:, -1:]).repeat(1, pad_size, 1)], 1)
-                            audio_cond_tmp = torch.chunk(audio_cond_tmp, sp_size, dim=1)[get_sequence_parallel_rank()]
-                        x = audio_cond_tmp + x
+                        x = self.inject_audio(x, audio_emb[:, au_idx], (f, h, w), audio_frame_ids)
 
                 if self.training and use_gradient_checkpointing:
                     if use_gradient_checkpointing_offload:
@@ -417,13 +529,13 @@ class WanModel(torch.nn.Module):
                             use_reentrant=False,
                         )
                 else:
-                    x = block(x, context, t_mod, freqs)
+                    x = block(x, context, t_mod, freqs, context_cache, timestep_modulation)
             if tea_cache is not None:
                 x_cache = get_sp_group().all_gather(x, dim=1) # TODO: the size should be devided by sp_size
                 x_cache = x_cache[:, :ori_x_len]
                 tea_cache.store(x_cache)
 
-        x = self.head(x, t)
+        x = self.head(x, t, timestep_modulation)
         if args.sp_size > 1:
             # Context Parallel
             x = get_sp_group().all_gather(x, dim=1) # TODO: the size should be devided by sp_size
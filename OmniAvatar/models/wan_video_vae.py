@@ -39,9 +39,26 @@ class CausalConv3d(nn.Conv3d):
         super().__init__(*args, **kwargs)
         self._padding = (self.padding[2], self.padding[2], self.padding[1],
                          self.padding[1], 2 * self.padding[0], 0)
+        self.spatial_padding = (0, self.padding[1], self.padding[2])
         self.padding = (0, 0, 0)
+        self.fast_mode = True
 
     def forward(self, x, cache_x=None):
+        if self.fast_mode:
+            # The spatial padding is done by the convolution itself and the temporal one (cache and/or zeros)
+            # by a single concatenation, instead of concatenating the cache and then padding the whole tensor
+            pad_t = self._padding[4]
+            parts = []
+            if cache_x is not None and pad_t > 0:
+                parts.append(cache_x.to(x.device))
+                pad_t -= cache_x.shape[2]
+            if pad_t > 0:
+                parts.insert(0, x.new_zeros((*x.shape[:2], pad_t, *x.shape[3:])))
+            if parts:
+                x = torch.cat([*parts, x], dim=2)
+            if pad_t < 0:
+                x = x[:, :, -pad_t:]
+            return F.conv3d(x, self.weight, self.bias, self.stride, self.spatial_padding, self.dilation, self.groups)
         padding = list(self._padding)
         if cache_x is not None and self._padding[4] > 0:
             cache_x = cache_x.to(x.device)
@@ -515,6 +532,9 @@ class VideoVAE_(nn.Module):
         self.conv2 = CausalConv3d(z_dim, z_dim, 1)
         self.decoder = Decoder3d(dim, z_dim, dim_mult, num_res_blocks,
                                  attn_scales, self.temperal_upsample, dropout)
+        self._conv_counts = None
+        self._decode_cache_elements = None
+        self.fast_mode = True
 
     def forward(self, x):
         mu, log_var = self.encode(x)
@@ -531,14 +551,20 @@ class VideoVAE_(nn.Module):
         for i in range(iter_):
             self._enc_conv_idx = [0]
             if i == 0:
-                out = self.encoder(x[:, :, :1, :, :],
-                                   feat_cache=self._enc_feat_map,
-                                   feat_idx=self._enc_conv_idx)
+                out_ = self.encoder(x[:, :, :1, :, :],
+                                    feat_cache=self._enc_feat_map,
+                                    feat_idx=self._enc_conv_idx)
             else:
                 out_ = self.encoder(x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
                                     feat_cache=self._enc_feat_map,
                                     feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
+            if not self.fast_mode:
+                out = out_ if i == 0 else torch.cat([out, out_], 2)
+                continue
+            # Each step yields one latent frame, written into an output allocated once
+            if i == 0:
+                out = out_.new_empty((*out_.shape[:2], iter_, *out_.shape[3:]))
+            out[:, :, i:i + 1] = out_
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             scale = [s.to(dtype=mu.dtype, device=mu.device) for s in scale]
@@ -551,6 +577,20 @@ class VideoVAE_(nn.Module):
 
     def decode(self, z, scale):
         self.clear_cache()
+        if not self.fast_mode:
+            return self.decode_reference(z, scale)
+        # The number of output frames is known: 1 for the first latent frame, then one per temporal upsampling factor
+        out, t = None, 0
+        for out_ in self.decode_stream(z, scale, feat_cache=self._feat_map):
+            if out is None:
+                num_frames = 1 + (z.shape[2] - 1) * 2 ** sum(self.temperal_upsample)
+                out = out_.new_empty((*out_.shape[:2], num_frames, *out_.shape[3:]))
+            out[:, :, t:t + out_.shape[2]] = out_
+            t += out_.shape[2]
+        return out
+
+    def decode_reference(self, z, scale):
+        # The original decode loop, kept as is for comparisons with the fast mode
         # z: [b,c,t,h,w]
         if isinstance(scale[0], torch.Tensor):
             scale = [s.to(dtype=z.dtype, device=z.device) for s in scale]
@@ -574,6 +614,25 @@ class VideoVAE_(nn.Module):
                 out = torch.cat([out, out_], 2) # may add tensor offload
         return out
 
+    def decode_stream(self, z, scale, feat_cache=None):
+        # Yields the decoded frames of each latent frame (1 frame for the first one, 4 for the others) as soon as
+        # they are produced. The causal cache lives in feat_cache, a new one unless given.
+        if feat_cache is None:
+            feat_cache = [None] * self.conv_counts()[0]
+        # z: [b,c,t,h,w]
+        if isinstance(scale[0], torch.Tensor):
+            scale = [s.to(dtype=z.dtype, device=z.device) for s in scale]
+            z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
+                1, self.z_dim, 1, 1, 1)
+        else:
+            scale = scale.to(dtype=z.dtype, device=z.device)
+            z = z / scale[1] + scale[0]
+        x = self.conv2(z)
+        for i in range(z.shape[2]):
+            yield self.decoder(x[:, :, i:i + 1, :, :],
+                               feat_cache=feat_cache,
+                               feat_idx=[0])
+
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
         eps = torch.randn_like(std)
@@ -586,16 +645,70 @@ class VideoVAE_(nn.Module):
         std = torch.exp(0.5 * log_var.clamp(-30.0, 20.0))
         return mu + std * torch.randn_like(std)
 
+    def conv_counts(self):
+        # (decoder, encoder) causal conv counts, the module tree does not change after construction
+        if self._conv_counts is None:
+            self._conv_counts = (count_conv3d(self.decoder), count_conv3d(self.encoder))
+        return self._conv_counts
+
+    def decode_cache_elements(self):
+        # Elements of the full causal decoder caches (2 frames per conv) per latent pixel, they scale with the area.
+        # Measured once by decoding a few frames of a 1x1 latent.
+        if self._decode_cache_elements is None:
+            param = next(self.decoder.parameters())
+            feat_cache = [None] * self.conv_counts()[0]
+            x = torch.zeros((1, self.z_dim, 1, 1, 1), dtype=param.dtype, device=param.device)
+            with torch.no_grad():
+                for _ in range(3):
+                    self.decoder(x, feat_cache=feat_cache, feat_idx=[0])
+            self._decode_cache_elements = sum(cache.numel() for cache in feat_cache if isinstance(cache, torch.Tensor))
+        return self._decode_cache_elements
+
+    def set_fast_mode(self, enabled):
+        # fast mode: preallocated encode/decode outputs and single-copy causal padding, same results
+        self.fast_mode = enabled
+        for module in self.modules():
+            if isinstance(module, CausalConv3d):
+                module.fast_mode = enabled
+
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
+        self._conv_num, self._enc_conv_num = self.conv_counts()
         self._conv_idx = [0]
         self._feat_map = [None] * self._conv_num
         # cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
         self._enc_conv_idx = [0]
         self._enc_feat_map = [None] * self._enc_conv_num
 
 
+class VAEDecodeSession:
+    # The causal decoder caches of one video, carried from chunk to chunk. A chunk that starts with latent frames the
+    # previous chunk already decoded only needs its new latent frames decoded, continuing from these caches.
+    def __init__(self):
+        self.key = None
+        self.feat_caches = None
+
+    @property
+    def started(self):
+        return self.feat_caches is not None
+
+    def caches(self, key, num_streams, num_convs):
+        # key: resolution and tiling, the caches of a different tiling cannot be continued
+        if key != self.key:
+            self.key = key
+            self.feat_caches = [[None] * num_convs for _ in range(num_streams)]
+        return self.feat_caches
+
+    def to(self, device):
+        # The caches are kept on the host while the DiT runs and moved back before the next decode
+        if self.feat_caches is not None:
+            self.feat_caches = [[cache.to(device) if isinstance(cache, torch.Tensor) else cache for cache in feat_cache] for feat_cache in self.feat_caches]
+        return self
+
+    def reset(self):
+        self.key = None
+        self.feat_caches = None
+
+
 class WanVideoVAE(nn.Module):
 
     def __init__(self, z_dim=16):
@@ -616,6 +729,8 @@ class WanVideoVAE(nn.Module):
         # init model
         self.model = VideoVAE_(z_dim=z_dim).eval().requires_grad_(False)
         self.upsampling_factor = 8
+        # blend masks by (shape, boundary, border width, dtype, device)
+        self.mask_cache = {}
 
 
     def build_1d_mask(self, length, left_bound, right_bound, border_width):
@@ -640,56 +755,149 @@ class WanVideoVAE(nn.Module):
         return mask
 
 
-    def tiled_decode(self, hidden_states, device, tile_size, tile_stride):
-        _, _, T, H, W = hidden_states.shape
+    def cached_mask(self, data, is_bound, border_width, dtype, device):
+        key = (tuple(data.shape[3:]), is_bound, border_width, dtype, str(device))
+        if key not in self.mask_cache:
+            self.mask_cache[key] = self.build_mask(data, is_bound, border_width).to(dtype=dtype, device=device)
+        return self.mask_cache[key]
+
+
+    def accumulator_device(self, device, num_bytes, reserved_bytes=0):
+        # Blend on the computation device when the accumulators fit next to the decoder activations, on the CPU otherwise.
+        # reserved_bytes: device memory that will be taken during the decode on top of the activations
+        if torch.device(device).type != "cuda":
+            return device
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        return device if num_bytes * 2 + reserved_bytes < free_bytes else "cpu"
+
+
+    def decode_cache_bytes(self, H, W, dtype, tiled=True, tile_size=(34, 34), tile_stride=(18, 16), tile_batch_size=1, tile_shard=(0, 1)):
+        # Device memory of the causal caches that a streaming decode of a H x W latent keeps until its last step.
+        # Every tile has its own caches, their size grows with the tile area.
+        if tiled:
+            batches = self.split_tile_batches(H, W, tile_size, tile_stride, tile_batch_size)[tile_shard[0]::tile_shard[1]]
+            num_pixels = sum((min(h_, H) - h) * (min(w_, W) - w) for batch in batches for h, h_, w, w_ in batch)
+        else:
+            num_pixels = H * W
+        return num_pixels * self.model.decode_cache_elements() * torch.tensor([], dtype=dtype).element_size()
+
+
+    def split_tile_batches(self, H, W, tile_size, tile_stride, tile_batch_size):
+        # Split tasks, grouped by tile shape so that tiles of the same shape are decoded as one batch
         size_h, size_w = tile_size
         stride_h, stride_w = tile_stride
-
-        # Split tasks
-        tasks = []
+        tasks = {}
         for h in range(0, H, stride_h):
             if (h-stride_h >= 0 and h-stride_h+size_h >= H): continue
             for w in range(0, W, stride_w):
                 if (w-stride_w >= 0 and w-stride_w+size_w >= W): continue
                 h_, w_ = h + size_h, w + size_w
-                tasks.append((h, h_, w, w_))
+                tasks.setdefault((min(h_, H) - h, min(w_, W) - w), []).append((h, h_, w, w_))
+        return [group[i:i + tile_batch_size] for group in tasks.values() for i in range(0, len(group), tile_batch_size)]
 
-        data_device = "cpu"
-        computation_device = device
 
-        out_T = T * 4 - 3
-        weight = torch.zeros((1, 1, out_T, H * self.upsampling_factor, W * self.upsampling_factor), dtype=hidden_states.dtype, device=data_device)
-        values = torch.zeros((1, 3, out_T, H * self.upsampling_factor, W * self.upsampling_factor), dtype=hidden_states.dtype, device=data_device)
+    def tiled_decode(self, hidden_states, device, tile_size, tile_stride, tile_batch_size=1, tile_shard=(0, 1), reduce_fn=None):
+        # tile_shard: (rank, world size), only every world size-th tile batch is decoded here.
+        # reduce_fn sums the blend accumulators of all ranks, it returns None on the ranks that do not get the result.
+        _, _, T, H, W = hidden_states.shape
+        size_h, size_w = tile_size
+        stride_h, stride_w = tile_stride
+        batches = self.split_tile_batches(H, W, tile_size, tile_stride, tile_batch_size)[tile_shard[0]::tile_shard[1]]
 
-        for h, h_, w, w_ in tasks:
-            hidden_states_batch = hidden_states[:, :, :, h:h_, w:w_].to(computation_device)
+        computation_device = device
+        out_T = T * 4 - 3
+        out_shape = (out_T, H * self.upsampling_factor, W * self.upsampling_factor)
+        num_bytes = 4 * out_shape[0] * out_shape[1] * out_shape[2] * hidden_states.element_size()
+        data_device = self.accumulator_device(computation_device, num_bytes)
+
+        weight = torch.zeros((1, 1, *out_shape), dtype=hidden_states.dtype, device=data_device)
+        values = torch.zeros((1, 3, *out_shape), dtype=hidden_states.dtype, device=data_device)
+        # The latents are small, they are copied to the computation device once instead of once per tile
+        hidden_states = hidden_states.to(computation_device)
+        border_width = ((size_h - stride_h) * self.upsampling_factor, (size_w - stride_w) * self.upsampling_factor)
+
+        for batch in batches:
+            hidden_states_batch = torch.cat([hidden_states[:, :, :, h:h_, w:w_] for h, h_, w, w_ in batch])
             hidden_states_batch = self.model.decode(hidden_states_batch, self.scale).to(data_device)
 
-            mask = self.build_mask(
-                hidden_states_batch,
-                is_bound=(h==0, h_>=H, w==0, w_>=W),
-                border_width=((size_h - stride_h) * self.upsampling_factor, (size_w - stride_w) * self.upsampling_factor)
-            ).to(dtype=hidden_states.dtype, device=data_device)
-
-            target_h = h * self.upsampling_factor
-            target_w = w * self.upsampling_factor
-            values[
-                :,
-                :,
-                :,
-                target_h:target_h + hidden_states_batch.shape[3],
-                target_w:target_w + hidden_states_batch.shape[4],
-            ] += hidden_states_batch * mask
-            weight[
-                :,
-                :,
-                :,
-                target_h: target_h + hidden_states_batch.shape[3],
-                target_w: target_w + hidden_states_batch.shape[4],
-            ] += mask
+            for (h, h_, w, w_), tile in zip(batch, hidden_states_batch.split(1)):
+                mask = self.cached_mask(tile, (h==0, h_>=H, w==0, w_>=W), border_width, hidden_states.dtype, data_device)
+                target_h = h * self.upsampling_factor
+                target_w = w * self.upsampling_factor
+                values[
+                    :,
+                    :,
+                    :,
+                    target_h:target_h + tile.shape[3],
+                    target_w:target_w + tile.shape[4],
+                ] += tile * mask
+                weight[
+                    :,
+                    :,
+                    :,
+                    target_h: target_h + tile.shape[3],
+                    target_w: target_w + tile.shape[4],
+                ] += mask
+        if reduce_fn is not None:
+            accumulators = reduce_fn(torch.cat([values, weight], dim=1))
+            if accumulators is None:
+                return None
+            values, weight = accumulators[:, :3], accumulators[:, 3:]
         values = values / weight
         values = values.clamp_(-1, 1)
-        return values
+        # The accumulators may be on the computation device, the decoded video is returned on the CPU
+        return values.cpu()
+
+
+    def tiled_decode_stream(self, hidden_states, device, tile_size, tile_stride, tile_batch_size=1, feat_caches=None, tile_shard=(0, 1), reduce_fn=None, continued=False):
+        # All tile batches are decoded in lockstep, one latent frame at a time, and the frames of each step are
+        # blended and yielded before the next step. Only the causal caches of the tiles are kept across steps.
+        # tile_shard and reduce_fn as in tiled_decode, the ranks without the result yield None for every step.
+        # continued: feat_caches hold a previous call's caches, the first step then yields 4 frames instead of 1.
+        _, _, T, H, W = hidden_states.shape
+        size_h, size_w = tile_size
+        stride_h, stride_w = tile_stride
+        batches = self.split_tile_batches(H, W, tile_size, tile_stride, tile_batch_size)[tile_shard[0]::tile_shard[1]]
+
+        computation_device = device
+        out_shape = (H * self.upsampling_factor, W * self.upsampling_factor)
+        # The caches of all tiles stay on the computation device until the last step
+        cache_bytes = 0 if continued else self.decode_cache_bytes(H, W, hidden_states.dtype, True, tile_size, tile_stride, tile_batch_size, tile_shard)
+        data_device = self.accumulator_device(computation_device, 4 * 4 * out_shape[0] * out_shape[1] * hidden_states.element_size(), cache_bytes)
+        hidden_states = hidden_states.to(computation_device)
+        border_width = ((size_h - stride_h) * self.upsampling_factor, (size_w - stride_w) * self.upsampling_factor)
+
+        # feat_caches: the causal caches of the tile batches, carried over from a previous call
+        if feat_caches is None:
+            feat_caches = [None] * len(batches)
+        streams = [self.model.decode_stream(torch.cat([hidden_states[:, :, :, h:h_, w:w_] for h, h_, w, w_ in batch]), self.scale, feat_cache=feat_cache) for batch, feat_cache in zip(batches, feat_caches)]
+        # The blend weights are the same for every frame, they are accumulated during the first step only
+        weight = torch.zeros((1, 1, 1, *out_shape), dtype=hidden_states.dtype, device=data_device)
+        for step in range(T):
+            values = None
+            for batch, stream in zip(batches, streams):
+                hidden_states_batch = next(stream).to(data_device)
+                if values is None:
+                    values = torch.zeros((1, 3, hidden_states_batch.shape[2], *out_shape), dtype=hidden_states.dtype, device=data_device)
+                for (h, h_, w, w_), tile in zip(batch, hidden_states_batch.split(1)):
+                    mask = self.cached_mask(tile, (h==0, h_>=H, w==0, w_>=W), border_width, hidden_states.dtype, data_device)
+                    target_h = h * self.upsampling_factor
+                    target_w = w * self.upsampling_factor
+                    values[:, :, :, target_h:target_h + tile.shape[3], target_w:target_w + tile.shape[4]] += tile * mask
+                    if step == 0:
+                        weight[:, :, :, target_h:target_h + tile.shape[3], target_w:target_w + tile.shape[4]] += mask
+            if values is None:
+                # this rank has no tile
+                num_frames = 1 if step == 0 and not continued else 2 ** sum(self.model.temperal_upsample)
+                values = torch.zeros((1, 3, num_frames, *out_shape), dtype=hidden_states.dtype, device=data_device)
+            if reduce_fn is not None:
+                if step == 0:
+                    weight = reduce_fn(weight)
+                values = reduce_fn(values)
+                if values is None:
+                    yield None
+                    continue
+            yield (values / weight).clamp_(-1, 1).cpu()
 
 
     def tiled_encode(self, video, device, tile_size, tile_stride):
@@ -773,21 +981,46 @@ class WanVideoVAE(nn.Module):
         return hidden_states
 
 
-    def decode(self, hidden_states, device, tiled=False, tile_size=(34, 34), tile_stride=(18, 16)):
+    def decode(self, hidden_states, device, tiled=False, tile_size=(34, 34), tile_stride=(18, 16), tile_batch_size=1, tile_shard=(0, 1), reduce_fn=None):
+        # tile_shard, reduce_fn: decode the tiles across ranks (see tiled_decode), None is returned on the ranks
+        # without the result. Untiled, the first rank decodes everything.
         hidden_states = [hidden_state.to("cpu") for hidden_state in hidden_states]
         videos = []
         for hidden_state in hidden_states:
             hidden_state = hidden_state.unsqueeze(0)
             if tiled:
-                video = self.tiled_decode(hidden_state, device, tile_size, tile_stride)
-            else:
+                video = self.tiled_decode(hidden_state, device, tile_size, tile_stride, tile_batch_size, tile_shard, reduce_fn)
+            elif tile_shard[0] == 0:
                 video = self.single_decode(hidden_state, device)
+            else:
+                video = None
+            if video is None:
+                return None
             video = video.squeeze(0)
             videos.append(video)
         videos = torch.stack(videos)
         return videos
 
 
+    def decode_stream(self, hidden_state, device, tiled=False, tile_size=(34, 34), tile_stride=(18, 16), tile_batch_size=1, session=None, tile_shard=(0, 1), reduce_fn=None):
+        # hidden_state: [1, c, t, h, w], yields [1, 3, t', H, W] frame groups as they are decoded
+        # session: a VAEDecodeSession, decoding continues from the causal caches of its previous call
+        # tile_shard, reduce_fn: as in decode, untiled the other ranks yield nothing
+        if not tiled and tile_shard[0] != 0:
+            return
+        feat_caches, continued = None, False
+        if session is not None:
+            num_streams = len(self.split_tile_batches(*hidden_state.shape[3:], tile_size, tile_stride, tile_batch_size)[tile_shard[0]::tile_shard[1]]) if tiled else 1
+            key = (tuple(hidden_state.shape[3:]), tiled, tuple(tile_size), tuple(tile_stride), tile_batch_size, tuple(tile_shard))
+            continued = session.key == key
+            feat_caches = session.caches(key, num_streams, self.model.conv_counts()[0])
+        if tiled:
+            yield from self.tiled_decode_stream(hidden_state, device, tile_size, tile_stride, tile_batch_size, feat_caches, tile_shard, reduce_fn, continued)
+        else:
+            for video in self.model.decode_stream(hidden_state.to(device), self.scale, feat_cache=None if feat_caches is None else feat_caches[0]):
+                yield video.clamp_(-1, 1)
+
+
     @staticmethod
     def state_dict_converter():
         return WanVideoVAEStateDictConverter()
@@ -1 +1,2 @@
-from .wan_prompter import WanPrompter
\ No newline at end of file
+from .wan_prompter import WanPrompter
+from .prompt_cache import PromptEmbeddingCache, file_fingerprint, directory_fingerprint
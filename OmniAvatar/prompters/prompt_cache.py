@@ -0,0 +1,77 @@
+import os, hashlib
+from collections import OrderedDict
+import torch
+from safetensors.torch import load_file, save_file
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    # Hashing a multi-GB checkpoint on every start would defeat the purpose of the cache,
+    # so the fingerprint is the file size plus the first and last MiB.
+    hasher = hashlib.sha256()
+    size = os.path.getsize(path)
+    hasher.update(str(size).encode())
+    with open(path, "rb") as f:
+        hasher.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            hasher.update(f.read(chunk_size))
+    return hasher.hexdigest()
+
+
+def directory_fingerprint(path):
+    # Fingerprint of every file in a directory (e.g. a tokenizer), by relative name
+    hasher = hashlib.sha256()
+    for root, _, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            hasher.update(f"{os.path.relpath(file_path, path)}|{file_fingerprint(file_path)}\n".encode())
+    return hasher.hexdigest()
+
+
+class PromptEmbeddingCache:
+    def __init__(self, fingerprint="", cache_dir=None, max_size=16):
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.embeddings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, prompt):
+        return hashlib.sha256(f"{self.fingerprint}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def get(self, key):
+        if key in self.embeddings:
+            self.embeddings.move_to_end(key)
+            self.hits += 1
+            return self.embeddings[key]
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            prompt_emb = load_file(self.path(key))["context"]
+            self.remember(key, prompt_emb)
+            self.hits += 1
+            return prompt_emb
+        self.misses += 1
+        return None
+
+    def put(self, key, prompt_emb):
+        prompt_emb = prompt_emb.detach().cpu().contiguous()
+        self.remember(key, prompt_emb)
+        if self.cache_dir is not None and not os.path.exists(self.path(key)):
+            # Several ranks may write the same prompt at once, so write to a private file and rename.
+            tmp_path = f"{self.path(key)}.{os.getpid()}.tmp"
+            save_file({"context": prompt_emb}, tmp_path, metadata={"fingerprint": self.fingerprint})
+            os.replace(tmp_path, self.path(key))
+
+    def remember(self, key, prompt_emb):
+        self.embeddings[key] = prompt_emb
+        self.embeddings.move_to_end(key)
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+    def clear(self):
+        self.embeddings.clear()
@@ -1,4 +1,5 @@
 from .base_prompter import BasePrompter
+from .prompt_cache import PromptEmbeddingCache
 from ..models.wan_video_text_encoder import WanTextEncoder
 from transformers import AutoTokenizer
 import os, torch
@@ -87,6 +88,8 @@ class WanPrompter(BasePrompter):
         super().__init__()
         self.text_len = text_len
         self.text_encoder = None
+        self.prompt_cache = None
+        self.load_text_encoder = None
         self.fetch_tokenizer(tokenizer_path)
         
     def fetch_tokenizer(self, tokenizer_path=None):
@@ -96,9 +99,24 @@ class WanPrompter(BasePrompter):
     def fetch_models(self, text_encoder: WanTextEncoder = None):
         self.text_encoder = text_encoder
 
+    def fetch_prompt_cache(self, prompt_cache: PromptEmbeddingCache = None, load_text_encoder=None):
+        # load_text_encoder is called before the text encoder runs, so it can be loaded lazily on the first cache miss
+        self.prompt_cache = prompt_cache
+        self.load_text_encoder = load_text_encoder
+
     def encode_prompt(self, prompt, positive=True, device="cuda"):
         prompt = self.process_prompt(prompt, positive=positive)
         
+        cache_key = None
+        if self.prompt_cache is not None and isinstance(prompt, str):
+            # Same normalisation as the tokenizer, so prompts that only differ in whitespace share an entry
+            cache_key = self.prompt_cache.key(whitespace_clean(basic_clean(prompt)))
+            prompt_emb = self.prompt_cache.get(cache_key)
+            if prompt_emb is not None:
+                return prompt_emb.to(device)
+        if self.load_text_encoder is not None:
+            self.load_text_encoder()
+
         ids, mask = self.tokenizer(prompt, return_mask=True, add_special_tokens=True)
         ids = ids.to(device)
         mask = mask.to(device)
@@ -106,4 +124,6 @@ class WanPrompter(BasePrompter):
         prompt_emb = self.text_encoder(ids, mask)
         for i, v in enumerate(seq_lens):
             prompt_emb[:, v:] = 0
+        if cache_key is not None:
+            self.prompt_cache.put(cache_key, prompt_emb)
         return prompt_emb
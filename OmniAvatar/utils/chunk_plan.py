@@ -0,0 +1,23 @@
+def plan_chunks(num_frames, L, first_fixed_frame, fixed_frame):
+    # 每段的视频帧数(4n+1)，前面的段都是L帧，最后一段只取覆盖剩余帧所需的最短长度
+    # num_frames: 需要新生成的帧数；每段的前overlap帧(第一段first_fixed_frame，之后fixed_frame)来自参考帧/上一段
+    plan = []
+    remaining = num_frames
+    while remaining > 0 or len(plan) == 0:
+        overlap = first_fixed_frame if len(plan) == 0 else fixed_frame
+        frames = overlap + min(L - overlap, max(remaining, 1))
+        frames = (frames + 2) // 4 * 4 + 1
+        plan.append(frames)
+        remaining -= frames - overlap
+    return plan
+
+
+def summarize_chunk_plan(plan, size):
+    # size: (h, w) of the video; the DiT sees one token per 2x2 latent pixels (16x16 video pixels) per latent frame
+    latent_frames = [(frames + 3) // 4 for frames in plan]
+    return {
+        "chunks": len(plan),
+        "video_frames": plan,
+        "latent_frames": latent_frames,
+        "tokens": [latent_frame * size[0] * size[1] // 256 for latent_frame in latent_frames],
+    }
@@ -12,57 +12,94 @@ from glob import glob
 import soundfile as sf
 from einops import rearrange
 import hashlib
+import json, struct, threading
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# init_weights_on_device patches torch.nn.Module and the torch tensor constructors for the whole process, but the
+# patched functions only redirect to the device in the threads that are inside init_weights_on_device: other threads
+# can build (and load) modules at the same time. The lock is only held while the patch is installed or removed.
+# Code that patches torch.nn.Module for the whole process itself (transformers' from_pretrained) must hold the lock
+# throughout, so that the two patches are never stacked and each one restores exactly what it replaced.
+init_weights_lock = threading.RLock()
+init_weights_state = threading.local()
+init_weights_originals = {}
+init_weights_users = 0
+
+def init_weights_target():
+    # (device, include_buffers) of the innermost init_weights_on_device of this thread, None outside of it
+    stack = getattr(init_weights_state, "stack", None)
+    return stack[-1] if stack else None
+
 @contextmanager
 def init_weights_on_device(device = torch.device("meta"), include_buffers :bool = False):
-    
-    old_register_parameter = torch.nn.Module.register_parameter
-    if include_buffers:
-        old_register_buffer = torch.nn.Module.register_buffer
-    
-    def register_empty_parameter(module, name, param):
-        old_register_parameter(module, name, param)
-        if param is not None:
-            param_cls = type(module._parameters[name])
-            kwargs = module._parameters[name].__dict__
-            kwargs["requires_grad"] = param.requires_grad
-            module._parameters[name] = param_cls(module._parameters[name].to(device), **kwargs)
-
-    def register_empty_buffer(module, name, buffer, persistent=True):
-        old_register_buffer(module, name, buffer, persistent=persistent)
-        if buffer is not None:
-            module._buffers[name] = module._buffers[name].to(device)
-            
-    def patch_tensor_constructor(fn):
-        def wrapper(*args, **kwargs):
-            kwargs["device"] = device
-            return fn(*args, **kwargs)
-
-        return wrapper
-    
-    if include_buffers:
-        tensor_constructors_to_patch = {
-            torch_function_name: getattr(torch, torch_function_name)
-            for torch_function_name in ["empty", "zeros", "ones", "full"]
-        }
-    else:
-        tensor_constructors_to_patch = {}
-    
+    if not hasattr(init_weights_state, "stack"):
+        init_weights_state.stack = []
+    init_weights_state.stack.append((device, include_buffers))
+    install_weights_init_patch()
     try:
-        torch.nn.Module.register_parameter = register_empty_parameter
-        if include_buffers:
-            torch.nn.Module.register_buffer = register_empty_buffer
-        for torch_function_name in tensor_constructors_to_patch.keys():
-            setattr(torch, torch_function_name, patch_tensor_constructor(getattr(torch, torch_function_name)))
         yield
     finally:
-        torch.nn.Module.register_parameter = old_register_parameter
-        if include_buffers:
-            torch.nn.Module.register_buffer = old_register_buffer
-        for torch_function_name, old_torch_function in tensor_constructors_to_patch.items():
-            setattr(torch, torch_function_name, old_torch_function)
+        init_weights_state.stack.pop()
+        remove_weights_init_patch()
+
+def install_weights_init_patch():
+    global init_weights_users
+    with init_weights_lock:
+        init_weights_users += 1
+        if init_weights_users > 1:
+            return
+        old_register_parameter = torch.nn.Module.register_parameter
+        old_register_buffer = torch.nn.Module.register_buffer
+        init_weights_originals["register_parameter"] = old_register_parameter
+        init_weights_originals["register_buffer"] = old_register_buffer
+
+        def register_empty_parameter(module, name, param):
+            old_register_parameter(module, name, param)
+            target = init_weights_target()
+            if target is not None and param is not None:
+                param_cls = type(module._parameters[name])
+                kwargs = module._parameters[name].__dict__
+                kwargs["requires_grad"] = param.requires_grad
+                module._parameters[name] = param_cls(module._parameters[name].to(target[0]), **kwargs)
+
+        def register_empty_buffer(module, name, buffer, persistent=True):
+            old_register_buffer(module, name, buffer, persistent=persistent)
+            target = init_weights_target()
+            if target is not None and target[1] and buffer is not None:
+                module._buffers[name] = module._buffers[name].to(target[0])
+
+        def patch_tensor_constructor(fn):
+            def wrapper(*args, **kwargs):
+                target = init_weights_target()
+                if target is not None and target[1]:
+                    kwargs["device"] = target[0]
+                return fn(*args, **kwargs)
+
+            return wrapper
+
+        torch.nn.Module.register_parameter = register_empty_parameter
+        torch.nn.Module.register_buffer = register_empty_buffer
+        init_weights_originals["patched"] = {"register_parameter": register_empty_parameter, "register_buffer": register_empty_buffer}
+        for torch_function_name in ["empty", "zeros", "ones", "full"]:
+            init_weights_originals[torch_function_name] = getattr(torch, torch_function_name)
+            setattr(torch, torch_function_name, patch_tensor_constructor(getattr(torch, torch_function_name)))
+            init_weights_originals["patched"][torch_function_name] = getattr(torch, torch_function_name)
+
+def remove_weights_init_patch():
+    global init_weights_users
+    with init_weights_lock:
+        init_weights_users -= 1
+        if init_weights_users > 0:
+            return
+        # Holding the lock, nothing else can have patched these functions on top of ours
+        patched = init_weights_originals.pop("patched")
+        for name in ["register_parameter", "register_buffer"]:
+            assert getattr(torch.nn.Module, name) is patched[name], f"torch.nn.Module.{name} was patched without init_weights_lock"
+            setattr(torch.nn.Module, name, init_weights_originals.pop(name))
+        for torch_function_name in ["empty", "zeros", "ones", "full"]:
+            assert getattr(torch, torch_function_name) is patched[torch_function_name], f"torch.{torch_function_name} was patched without init_weights_lock"
+            setattr(torch, torch_function_name, init_weights_originals.pop(torch_function_name))
 
 def load_state_dict_from_folder(file_path, torch_dtype=None):
     state_dict = {}
@@ -74,14 +111,20 @@ def load_state_dict_from_folder(file_path, torch_dtype=None):
     return state_dict
 
 
-def load_state_dict(file_path, torch_dtype=None):
+def load_state_dict(file_path, torch_dtype=None, mmap=False):
+    # mmap: return tensors backed by a private mapping of the file, read lazily when first touched
     if file_path.endswith(".safetensors"):
-        return load_state_dict_from_safetensors(file_path, torch_dtype=torch_dtype)
+        return load_state_dict_from_safetensors(file_path, torch_dtype=torch_dtype, mmap=mmap)
     else:
-        return load_state_dict_from_bin(file_path, torch_dtype=torch_dtype)
+        return load_state_dict_from_bin(file_path, torch_dtype=torch_dtype, mmap=mmap)
 
 
-def load_state_dict_from_safetensors(file_path, torch_dtype=None):
+def load_state_dict_from_safetensors(file_path, torch_dtype=None, mmap=False):
+    if mmap:
+        state_dict = map_safetensors(file_path)
+        if torch_dtype is not None:
+            state_dict = {k: v.to(torch_dtype) for k, v in state_dict.items()}
+        return state_dict
     state_dict = {}
     with safe_open(file_path, framework="pt", device="cpu") as f:
         for k in f.keys():
@@ -91,14 +134,77 @@ def load_state_dict_from_safetensors(file_path, torch_dtype=None):
     return state_dict
 
 
-def load_state_dict_from_bin(file_path, torch_dtype=None):
-    state_dict = torch.load(file_path, map_location="cpu", weights_only=True)
+def load_state_dict_from_bin(file_path, torch_dtype=None, mmap=False):
+    try:
+        state_dict = torch.load(file_path, map_location="cpu", weights_only=True, mmap=mmap)
+    except RuntimeError:
+        if not mmap:
+            raise
+        # legacy (non-zip) checkpoints cannot be mapped
+        state_dict = torch.load(file_path, map_location="cpu", weights_only=True)
     if torch_dtype is not None:
         for i in state_dict:
             if isinstance(state_dict[i], torch.Tensor):
                 state_dict[i] = state_dict[i].to(torch_dtype)
     return state_dict
 
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def read_safetensors_header(file_path):
+    # (header, offset of the data section)
+    with open(file_path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return header, 8 + header_size
+
+
+def map_safetensors(file_path, shared=False):
+    # Tensors of a safetensors file as views of one mapping of the file; a private mapping (shared=False)
+    # is copy-on-write, a shared one is backed by the file itself
+    header, data_offset = read_safetensors_header(file_path)
+    storage = torch.UntypedStorage.from_file(file_path, shared=shared, nbytes=os.path.getsize(file_path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    state_dict = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        tensor = data[data_offset + begin: data_offset + end]
+        state_dict[name] = tensor.view(SAFETENSORS_DTYPES[info["dtype"]]).view(info["shape"])
+    return state_dict
+
+
+def read_into_page_cache(file_path, chunk_size=64 << 20):
+    # Reads the file once so that the pages of a mapping of it are cached by the time they are touched
+    buffer = bytearray(chunk_size)
+    with open(file_path, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def load_state_dict_metadata(file_path):
+    # Keys, shapes and dtypes as meta tensors, which is all the model detectors look at
+    if file_path.endswith(".safetensors"):
+        header, _ = read_safetensors_header(file_path)
+        return {
+            name: torch.empty(info["shape"], dtype=SAFETENSORS_DTYPES[info["dtype"]], device="meta")
+            for name, info in header.items()
+        }
+    # Only the pickle is read, the tensor data stays in the (unread) mapping
+    return to_meta(load_state_dict_from_bin(file_path, mmap=True))
+
+
+def to_meta(state_dict):
+    return {
+        key: value.to("meta") if isinstance(value, torch.Tensor) else to_meta(value) if isinstance(value, dict) else value
+        for key, value in state_dict.items()
+    }
+
+
 def smart_load_weights(model, ckpt_state_dict):
     model_state_dict = model.state_dict()
     new_state_dict = {}
@@ -124,6 +230,45 @@ def smart_load_weights(model, ckpt_state_dict):
     missing_keys, unexpected_keys = model.load_state_dict(new_state_dict, assign=True, strict=False)
     return model, missing_keys, unexpected_keys
 
+def materialize_weights(model, ckpt_state_dict, torch_dtype, device):
+    # smart_load_weights + model.to(dtype, device) for a model built on the meta device, one tensor at a time:
+    # every parameter is created once, directly in its final dtype and device, and checkpoint tensors that are
+    # already there (e.g. mapped bf16 tensors loaded to the cpu) are used as they are, without a copy.
+    device = torch.device(device)
+    materialized = {}
+    def materialize(name, tensor):
+        dtype = torch_dtype if tensor.is_floating_point() else tensor.dtype
+        ckpt_tensor = ckpt_state_dict.get(name)
+        if ckpt_tensor is None:
+            # like to_empty: left uninitialized
+            return torch.empty(tensor.shape, dtype=dtype, device=device)
+        if ckpt_tensor.shape != tensor.shape:
+            new_tensor = torch.empty(tensor.shape, dtype=dtype, device=device)
+            if all(p >= c for p, c in zip(tensor.shape, ckpt_tensor.shape)):
+                print(f"[Truncate] {name}: ckpt {ckpt_tensor.shape} -> model {tensor.shape}")
+                new_tensor[tuple(slice(0, c) for c in ckpt_tensor.shape)] = ckpt_tensor
+            else:
+                print(f"[Skip] {name}: ckpt {ckpt_tensor.shape} is larger than model {tensor.shape}")
+            return new_tensor
+        return ckpt_tensor.to(dtype=dtype, device=device)
+
+    for module_name, module in model.named_modules():
+        prefix = f"{module_name}." if module_name else ""
+        for name, param in list(module._parameters.items()):
+            if param is None:
+                continue
+            if id(param) not in materialized: # tied parameters stay tied
+                materialized[id(param)] = torch.nn.Parameter(materialize(prefix + name, param), requires_grad=param.requires_grad)
+            module._parameters[name] = materialized[id(param)]
+        for name, buffer in list(module._buffers.items()):
+            if buffer is None:
+                continue
+            if prefix + name in ckpt_state_dict or buffer.is_meta:
+                module._buffers[name] = materialize(prefix + name, buffer)
+            else:
+                module._buffers[name] = buffer.to(dtype=torch_dtype if buffer.is_floating_point() else buffer.dtype, device=device)
+    return model
+
 def save_wav(audio, audio_path):
     if isinstance(audio, torch.Tensor):
         audio = audio.float().detach().cpu().numpy()
@@ -143,7 +288,9 @@ def save_video_as_grid_and_mp4(video_batch: torch.Tensor, save_path: str, fps: f
             gif_frames = []
             for frame in vid:
                 frame = rearrange(frame, "c h w -> h w c")
-                frame = (255.0 * frame).cpu().numpy().astype(np.uint8)
+                if frame.dtype != torch.uint8:
+                    frame = 255.0 * frame
+                frame = frame.cpu().numpy().astype(np.uint8)
                 gif_frames.append(frame)
             if prefix is not None:
                 now_save_path = os.path.join(save_path, f"{prefix}_{i:03d}.mp4")
@@ -0,0 +1,32 @@
+from peft import LoraConfig, inject_adapter_in_model
+from .io_utils import load_state_dict
+
+
+def add_lora_to_model(model, lora_rank=4, lora_alpha=4, lora_target_modules="q,k,v,o,ffn.0,ffn.2", init_lora_weights="kaiming", pretrained_lora_path=None, state_dict_converter=None):
+    # Injects LoRA adapters into the model in place and loads pretrained_lora_path into it (the checkpoint holds the
+    # adapters and the trained modules, not the base weights). Returns the missing and unexpected keys of the load.
+    if init_lora_weights == "kaiming":
+        init_lora_weights = True
+        
+    lora_config = LoraConfig(
+        r=lora_rank,
+        lora_alpha=lora_alpha,
+        init_lora_weights=init_lora_weights,
+        target_modules=lora_target_modules.split(","),
+    )
+    model = inject_adapter_in_model(lora_config, model)
+            
+    # Lora pretrained lora weights
+    missing_keys, unexpected_keys = [], []
+    if pretrained_lora_path is not None:
+        state_dict = load_state_dict(pretrained_lora_path)
+        if state_dict_converter is not None:
+            state_dict = state_dict_converter(state_dict)
+        missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+        all_keys = [i for i, _ in model.named_parameters()]
+        num_updated_keys = len(all_keys) - len(missing_keys)
+        num_unexpected_keys = len(unexpected_keys)
+        print(f"{num_updated_keys} parameters are loaded from {pretrained_lora_path}. {num_unexpected_keys} parameters are unexpected.")
+        if num_unexpected_keys > 0:
+            print(f"Unexpected keys in {pretrained_lora_path}: {', '.join(unexpected_keys[:10])}{' ...' if num_unexpected_keys > 10 else ''}")
+    return missing_keys, unexpected_keys
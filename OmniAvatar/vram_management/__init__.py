@@ -1 +1,4 @@
 from .layers import *
+from .streaming import WeightStreamer
+from .planner import VramPlanner, measure_host_to_device_bandwidth
+from .residency import ResidencyManager
@@ -1,4 +1,4 @@
-import torch, copy
+import torch
 from ..utils.io_utils import init_weights_on_device
 
 
@@ -8,6 +8,40 @@ def cast_to(weight, dtype, device):
     return r
 
 
+def host_tensors(module):
+    return {name: tensor.data for name, tensor in [*module.named_parameters(), *module.named_buffers()]}
+
+
+def restore_host_tensors(module, tensors):
+    for name, tensor in [*module.named_parameters(), *module.named_buffers()]:
+        tensor.data = tensors[name]
+
+
+class CastParameterCache:
+    # Parameters of wrapped modules already cast to the computation dtype/device, bounded in bytes.
+    # Wrapped modules always run in the same order, so an LRU would evict every entry right before it is needed again;
+    # instead entries are admitted until the budget is full and the remaining modules keep casting on the fly.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.params = {}
+
+    def get(self, module, fn):
+        if module in self.params:
+            return self.params[module]
+        params = fn()
+        num_bytes = sum(param.numel() * param.element_size() for param in params.values())
+        if self.num_bytes + num_bytes <= self.max_bytes:
+            self.params[module] = params
+            self.num_bytes += num_bytes
+        return params
+
+    def pop(self, module):
+        params = self.params.pop(module, None)
+        if params is not None:
+            self.num_bytes -= sum(param.numel() * param.element_size() for param in params.values())
+
+
 class AutoWrappedModule(torch.nn.Module):
     def __init__(self, module: torch.nn.Module, offload_dtype, offload_device, onload_dtype, onload_device, computation_dtype, computation_device):
         super().__init__()
@@ -19,23 +53,48 @@ class AutoWrappedModule(torch.nn.Module):
         self.computation_dtype = computation_dtype
         self.computation_device = computation_device
         self.state = 0
+        self.host_tensors = None
+        self.weight_streamer = None
+        self.cast_cache = None
 
-    def offload(self):
+    def offload(self, non_blocking=False):
+        if self.cast_cache is not None:
+            self.cast_cache.pop(self)
         if self.state == 1 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
-            self.module.to(dtype=self.offload_dtype, device=self.offload_device)
+            restore_host_tensors(self.module, self.host_tensors)
+            self.host_tensors = None
             self.state = 0
 
-    def onload(self):
+    def onload(self, non_blocking=False):
         if self.state == 0 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
-            self.module.to(dtype=self.onload_dtype, device=self.onload_device)
+            # Weights are not modified during inference, so the host copy is kept and put back on offload instead of copying back
+            self.host_tensors = host_tensors(self.module)
+            self.module.to(dtype=self.onload_dtype, device=self.onload_device, non_blocking=non_blocking)
             self.state = 1
 
     def forward(self, *args, **kwargs):
         if self.onload_dtype == self.computation_dtype and self.onload_device == self.computation_device:
             module = self.module
+        elif self.weight_streamer is not None:
+            params = self.weight_streamer.fetch(self, dtype=self.computation_dtype)
+            output = torch.func.functional_call(self.module, params, args, kwargs)
+            self.weight_streamer.release(self)
+            return output
         else:
-            module = copy.deepcopy(self.module).to(dtype=self.computation_dtype, device=self.computation_device)
+            # Run the module with cast copies of its parameters and buffers instead of deep-copying it
+            if self.cast_cache is None:
+                params = self.cast_parameters()
+            else:
+                params = self.cast_cache.get(self, self.cast_parameters)
+            return torch.func.functional_call(self.module, params, args, kwargs)
         return module(*args, **kwargs)
+
+    def cast_parameters(self):
+        params = {}
+        for name, tensor in [*self.module.named_parameters(), *self.module.named_buffers()]:
+            dtype = self.computation_dtype if tensor.is_floating_point() else tensor.dtype
+            params[name] = cast_to(tensor, dtype, self.computation_device)
+        return params
     
 
 class AutoWrappedLinear(torch.nn.Linear):
@@ -51,32 +110,104 @@ class AutoWrappedLinear(torch.nn.Linear):
         self.computation_dtype = computation_dtype
         self.computation_device = computation_device
         self.state = 0
+        self.host_tensors = None
+        self.weight_streamer = None
+        self.cast_cache = None
 
-    def offload(self):
+    def offload(self, non_blocking=False):
+        if self.cast_cache is not None:
+            self.cast_cache.pop(self)
         if self.state == 1 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
-            self.to(dtype=self.offload_dtype, device=self.offload_device)
+            restore_host_tensors(self, self.host_tensors)
+            self.host_tensors = None
             self.state = 0
 
-    def onload(self):
+    def onload(self, non_blocking=False):
         if self.state == 0 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
-            self.to(dtype=self.onload_dtype, device=self.onload_device)
+            self.host_tensors = host_tensors(self)
+            self.to(dtype=self.onload_dtype, device=self.onload_device, non_blocking=non_blocking)
             self.state = 1
 
     def forward(self, x, *args, **kwargs):
         if self.onload_dtype == self.computation_dtype and self.onload_device == self.computation_device:
             weight, bias = self.weight, self.bias
+        elif self.weight_streamer is not None:
+            params = self.weight_streamer.fetch(self, dtype=self.computation_dtype)
+            x = torch.nn.functional.linear(x, params["weight"], params.get("bias"))
+            self.weight_streamer.release(self)
+            return x
+        elif self.cast_cache is not None:
+            params = self.cast_cache.get(self, self.cast_parameters)
+            weight, bias = params["weight"], params.get("bias")
         else:
             weight = cast_to(self.weight, self.computation_dtype, self.computation_device)
             bias = None if self.bias is None else cast_to(self.bias, self.computation_dtype, self.computation_device)
         return torch.nn.functional.linear(x, weight, bias)
 
+    def cast_parameters(self):
+        params = {"weight": cast_to(self.weight, self.computation_dtype, self.computation_device)}
+        if self.bias is not None:
+            params["bias"] = cast_to(self.bias, self.computation_dtype, self.computation_device)
+        return params
+
+
+class AutoWrappedEmbedding(torch.nn.Embedding):
+    def __init__(self, module: torch.nn.Embedding, offload_dtype, offload_device, onload_dtype, onload_device, computation_dtype, computation_device):
+        with init_weights_on_device(device=torch.device("meta")):
+            super().__init__(num_embeddings=module.num_embeddings, embedding_dim=module.embedding_dim, padding_idx=module.padding_idx,
+                             max_norm=module.max_norm, norm_type=module.norm_type, scale_grad_by_freq=module.scale_grad_by_freq,
+                             sparse=module.sparse, dtype=offload_dtype, device=offload_device)
+        self.weight = module.weight
+        self.offload_dtype = offload_dtype
+        self.offload_device = offload_device
+        self.onload_dtype = onload_dtype
+        self.onload_device = onload_device
+        self.computation_dtype = computation_dtype
+        self.computation_device = computation_device
+        self.state = 0
+        self.host_tensors = None
+
+    def offload(self, non_blocking=False):
+        if self.state == 1 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
+            restore_host_tensors(self, self.host_tensors)
+            self.host_tensors = None
+            self.state = 0
+
+    def onload(self, non_blocking=False):
+        if self.state == 0 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
+            self.host_tensors = host_tensors(self)
+            self.to(dtype=self.onload_dtype, device=self.onload_device, non_blocking=non_blocking)
+            self.state = 1
+
+    def forward(self, x, *args, **kwargs):
+        if self.onload_dtype == self.computation_dtype and self.onload_device == self.computation_device:
+            return torch.nn.functional.embedding(x, self.weight, self.padding_idx, self.max_norm, self.norm_type, self.scale_grad_by_freq, self.sparse)
+        # Look the rows up where the table lives and only transfer the gathered rows
+        rows = torch.nn.functional.embedding(x.to(self.weight.device), self.weight, self.padding_idx, self.max_norm, self.norm_type, self.scale_grad_by_freq, self.sparse)
+        if rows.device.type == "cpu" and torch.device(self.computation_device).type == "cuda":
+            rows = rows.pin_memory()
+        return rows.to(dtype=self.computation_dtype, device=self.computation_device, non_blocking=True)
+
+
+def list_vram_managed_modules(model: torch.nn.Module, module_map: dict, prefix=""):
+    # (qualified name, module) of every module that enable_vram_management would wrap
+    modules = []
+    for name, module in model.named_children():
+        if isinstance(module, tuple(module_map)):
+            modules.append((prefix + name, module))
+        else:
+            modules += list_vram_managed_modules(module, module_map, prefix + name + ".")
+    return modules
+
 
-def enable_vram_management_recursively(model: torch.nn.Module, module_map: dict, module_config: dict, max_num_param=None, overflow_module_config: dict = None, total_num_param=0):
+def enable_vram_management_recursively(model: torch.nn.Module, module_map: dict, module_config: dict, max_num_param=None, overflow_module_config: dict = None, total_num_param=0, persistent_modules=None, prefix=""):
     for name, module in model.named_children():
         for source_module, target_module in module_map.items():
             if isinstance(module, source_module):
                 num_param = sum(p.numel() for p in module.parameters())
-                if max_num_param is not None and total_num_param + num_param > max_num_param:
+                if persistent_modules is not None:
+                    module_config_ = module_config if prefix + name in persistent_modules else overflow_module_config
+                elif max_num_param is not None and total_num_param + num_param > max_num_param:
                     module_config_ = overflow_module_config
                 else:
                     module_config_ = module_config
@@ -85,11 +216,17 @@ def enable_vram_management_recursively(model: torch.nn.Module, module_map: dict,
                 total_num_param += num_param
                 break
         else:
-            total_num_param = enable_vram_management_recursively(module, module_map, module_config, max_num_param, overflow_module_config, total_num_param)
+            total_num_param = enable_vram_management_recursively(module, module_map, module_config, max_num_param, overflow_module_config, total_num_param, persistent_modules, prefix + name + ".")
     return total_num_param
 
 
-def enable_vram_management(model: torch.nn.Module, module_map: dict, module_config: dict, max_num_param=None, overflow_module_config: dict = None):
-    enable_vram_management_recursively(model, module_map, module_config, max_num_param, overflow_module_config, total_num_param=0)
+def enable_vram_management(model: torch.nn.Module, module_map: dict, module_config: dict, max_num_param=None, overflow_module_config: dict = None, cast_cache_bytes=None, persistent_modules=None):
+    # persistent_modules: qualified names of the modules that use module_config, overrides max_num_param
+    enable_vram_management_recursively(model, module_map, module_config, max_num_param, overflow_module_config, total_num_param=0, persistent_modules=persistent_modules)
     model.vram_management_enabled = True
+    if cast_cache_bytes:
+        cast_cache = CastParameterCache(cast_cache_bytes)
+        for module in model.modules():
+            if isinstance(module, (AutoWrappedModule, AutoWrappedLinear)):
+                module.cast_cache = cast_cache
 
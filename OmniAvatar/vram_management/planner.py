@@ -0,0 +1,68 @@
+import time
+import torch
+
+
+def measure_host_to_device_bandwidth(device, num_bytes=256 * 1024**2, repeats=3):
+    if torch.device(device).type != "cuda":
+        return None
+    host = torch.empty(num_bytes, dtype=torch.uint8).pin_memory()
+    target = torch.empty(num_bytes, dtype=torch.uint8, device=device)
+    target.copy_(host, non_blocking=True)
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        target.copy_(host, non_blocking=True)
+    torch.cuda.synchronize(device)
+    return repeats * num_bytes / (time.perf_counter() - start)
+
+
+class VramPlanner:
+    # Decides, per model and per module, which weights stay resident on the device and which are streamed from the host.
+    # Models are planned one at a time because the pipeline only keeps one of them onloaded at once:
+    # for each model, the activation reserve of its phase is taken off the budget first, and the remaining memory is
+    # filled with the modules that would cost the most transfer time per byte if they were streamed.
+    def __init__(self, budget_bytes, bandwidth=None, latency=2e-5):
+        self.budget_bytes = budget_bytes
+        self.measured_bandwidth = bandwidth is not None
+        self.bandwidth = bandwidth if bandwidth is not None else 12 * 1024**3
+        self.latency = latency
+        self.lines = []
+
+    def transfer_cost(self, num_bytes, calls_per_step):
+        return calls_per_step * (self.latency + num_bytes / self.bandwidth)
+
+    def plan(self, name, modules, reserve_bytes):
+        # modules: [(qualified name, bytes, calls per denoising step)]
+        available = self.budget_bytes - reserve_bytes
+        ranked = sorted(modules, key=lambda m: self.transfer_cost(m[1], m[2]) / max(m[1], 1), reverse=True)
+        resident, resident_bytes = set(), 0
+        for module_name, num_bytes, calls_per_step in ranked:
+            if calls_per_step > 0 and resident_bytes + num_bytes <= available:
+                resident.add(module_name)
+                resident_bytes += num_bytes
+        streamed = [m for m in modules if m[0] not in resident]
+        streamed_bytes = sum(m[1] for m in streamed)
+        cost = sum(self.transfer_cost(m[1], m[2]) for m in streamed)
+        self.lines.append(
+            f"  {name}: {resident_bytes / 1024**3:.2f} GB resident, {streamed_bytes / 1024**3:.2f} GB streamed "
+            f"({len(resident)}/{len(modules)} modules resident), reserve {reserve_bytes / 1024**3:.2f} GB, "
+            f"est. transfer {cost:.3f} s/step"
+        )
+        if available < 0:
+            self.lines.append(f"  warning: the {name} activation reserve alone exceeds the budget")
+        return resident
+
+    def plan_model(self, name, num_bytes, reserve_bytes):
+        # All-or-nothing placement for models that run outside the denoising loop
+        resident = num_bytes + reserve_bytes <= self.budget_bytes
+        self.lines.append(
+            f"  {name}: {num_bytes / 1024**3:.2f} GB {'resident' if resident else 'streamed'}, reserve {reserve_bytes / 1024**3:.2f} GB"
+        )
+        return resident
+
+    def report(self):
+        source = "measured" if self.measured_bandwidth else "assumed"
+        return "\n".join([
+            f"VRAM plan (budget {self.budget_bytes / 1024**3:.2f} GB, host->device {self.bandwidth / 1024**3:.1f} GB/s {source}):",
+            *self.lines,
+        ])
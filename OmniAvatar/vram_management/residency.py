@@ -0,0 +1,84 @@
+import time
+import torch
+
+
+class ResidencyManager:
+    # Tracks which models are onloaded so that stage switches only move what changed.
+    # The modules that actually move (offload and onload configs differ) are collected once per model,
+    # the transfers are queued non-blocking and waited for once, and the allocator cache is only
+    # released when something was offloaded.
+    def __init__(self, device):
+        self.device = device
+        self.resident = None # unknown until the first switch, which then offloads everything not requested
+        self.managed_modules = {}
+        self.switches = 0
+        self.skipped = 0
+        self.moved_modules = 0
+        self.transfer_time = 0.0
+
+    def key(self, model):
+        # The flag is part of the key since enabling vram management replaces the submodules in place
+        return (model, getattr(model, "vram_management_enabled", False))
+
+    def movable_modules(self, model):
+        key = self.key(model)
+        if key not in self.managed_modules:
+            self.managed_modules[key] = [
+                module for module in model.modules()
+                if hasattr(module, "offload") and (module.offload_dtype != module.onload_dtype or module.offload_device != module.onload_device)
+            ]
+        return self.managed_modules[key]
+
+    def offload(self, model):
+        if getattr(model, "vram_management_enabled", False):
+            modules = self.movable_modules(model)
+            for module in modules:
+                module.offload(non_blocking=True)
+            return len(modules)
+        model.to("cpu", non_blocking=True)
+        return 1
+
+    def onload(self, model):
+        if getattr(model, "vram_management_enabled", False):
+            modules = self.movable_modules(model)
+            for module in modules:
+                module.onload(non_blocking=True)
+            return len(modules)
+        model.to(self.device, non_blocking=True)
+        return 1
+
+    def load(self, models, loadmodel_names):
+        # models: {name: model}, None entries are ignored
+        models = {name: model for name, model in models.items() if model is not None}
+        requested = {name for name in loadmodel_names if name in models}
+        if self.resident is None:
+            to_offload, to_onload = set(models) - requested, requested
+        else:
+            # A model replaced or rewrapped since the last switch (e.g. the lazily loaded text encoder) starts offloaded
+            resident = {name for name, key in self.resident.items() if name in models and self.key(models[name]) == key}
+            to_offload, to_onload = resident - requested, requested - resident
+        if not to_offload and not to_onload:
+            self.skipped += 1
+            return
+        start = time.perf_counter()
+        offloaded = 0
+        for name in to_offload:
+            offloaded += self.offload(models[name])
+        onloaded = 0
+        for name in to_onload:
+            onloaded += self.onload(models[name])
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize(self.device)
+            if offloaded > 0:
+                torch.cuda.empty_cache()
+        self.resident = {name: self.key(models[name]) for name in requested}
+        self.switches += 1
+        self.moved_modules += offloaded + onloaded
+        self.transfer_time += time.perf_counter() - start
+
+    def reset_stats(self):
+        self.switches, self.skipped, self.moved_modules, self.transfer_time = 0, 0, 0, 0.0
+
+    def report(self):
+        return (f"model residency: {self.switches} switches ({self.skipped} skipped), "
+                f"{self.moved_modules} modules moved, {self.transfer_time:.2f} s in transfers")
@@ -0,0 +1,168 @@
+import os
+import torch
+from collections import deque
+
+
+class StreamedWeights:
+    def __init__(self, offset, params, ready_event):
+        self.offset = offset
+        self.params = params
+        self.ready_event = ready_event
+        self.release_event = None
+        self.used = False
+
+
+class WeightStreamer:
+    # Streams the weights of offloaded modules from pinned host memory into a fixed-size device ring buffer.
+    # The execution order of the modules is learned on the fly (the successor of every module is the module that
+    # ran after it last time), and the weights of the upcoming modules are copied on a side stream while the
+    # current module computes. The buffer holds the current group of modules (e.g. a DiT block) plus `prefetch` groups.
+    # mapped_files: weight files mapped read-only by every rank (the shared weight store), parameters mapped from them
+    # are page-locked in place instead of being copied to private pinned memory.
+    def __init__(self, device, prefetch=2, alignment=256, mapped_files=()):
+        self.device = torch.device(device)
+        self.prefetch_groups = prefetch
+        self.capacity = 0
+        self.alignment = alignment
+        self.buffer = None
+        self.copy_stream = None
+        self.host_params = {}
+        self.mapped_files = {os.path.realpath(path) for path in mapped_files}
+        self.pinned_storages = {}
+        self.num_bytes = {}
+        self.group_bytes = {}
+        self.successor = {}
+        self.last_module = None
+        self.current_module = None
+        self.staged = {}
+        self.ring = deque()
+        self.head = 0
+        self.hits = 0
+        self.misses = 0
+        self.stalls = 0
+        self.streamed_bytes = 0
+
+    def register(self, module, group=None):
+        params = dict(getattr(module, "module", module).named_parameters())
+        for name, param in params.items():
+            if param.device.type == "cpu" and not param.is_pinned():
+                storage = param.untyped_storage()
+                if storage.filename is None or os.path.realpath(storage.filename) not in self.mapped_files or not self.pin_mapped_storage(storage):
+                    param.data = param.data.pin_memory()
+        self.host_params[module] = params
+        self.num_bytes[module] = sum(self.aligned(param.numel() * param.element_size()) for param in params.values())
+        group = module if group is None else group
+        self.group_bytes[group] = self.group_bytes.get(group, 0) + self.num_bytes[module]
+        self.capacity = max((self.prefetch_groups + 1) * max(self.group_bytes.values()), 2 * max(self.num_bytes.values()))
+        module.weight_streamer = self
+
+    def pin_mapped_storage(self, storage):
+        # Registered read-only: the pages stay shared with the other ranks' mappings. Returns False when the mapping
+        # cannot be registered, the parameters are then copied to pinned memory.
+        if storage.data_ptr() not in self.pinned_storages:
+            cudart = torch.cuda.cudart()
+            result = cudart.cudaHostRegister(storage.data_ptr(), storage.nbytes(), 8) # cudaHostRegisterReadOnly
+            self.pinned_storages[storage.data_ptr()] = result == cudart.cudaError.success
+            if not self.pinned_storages[storage.data_ptr()]:
+                print(f"Warning: cudaHostRegister failed for {storage.filename} ({result}), using pinned copies of its weights")
+        return self.pinned_storages[storage.data_ptr()]
+
+    def aligned(self, num_bytes):
+        return (num_bytes + self.alignment - 1) // self.alignment * self.alignment
+
+    def allocate(self, num_bytes, prefetch):
+        # Ring allocation; regions of older entries are reclaimed in FIFO order.
+        offset = self.head if self.head + num_bytes <= self.capacity else 0
+        end = offset + num_bytes
+        evicted = []
+        for module, entry in self.ring:
+            entry_end = entry.offset + self.num_bytes[module]
+            if entry.offset < end and entry_end > offset:
+                if module is self.current_module:
+                    # The weights of the module being fetched are about to be read
+                    return None
+                if prefetch and (not entry.used or entry.release_event is None):
+                    # Never throw away weights that are staged but not used yet, or still in use, just to prefetch more.
+                    return None
+                evicted.append(module)
+        for module in evicted:
+            entry = self.staged.pop(module)
+            self.ring.remove((module, entry))
+            if entry.release_event is not None:
+                self.copy_stream.wait_event(entry.release_event)
+        self.head = end
+        return offset
+
+    def stage(self, module, prefetch=False):
+        offset = self.allocate(self.num_bytes[module], prefetch)
+        if offset is None:
+            return False
+        params = {}
+        with torch.cuda.stream(self.copy_stream):
+            position = offset
+            for name, host_param in self.host_params[module].items():
+                num_bytes = host_param.numel() * host_param.element_size()
+                param = self.buffer[position: position + num_bytes].view(host_param.dtype).view(host_param.shape)
+                param.copy_(host_param, non_blocking=True)
+                params[name] = param
+                position += self.aligned(num_bytes)
+            ready_event = torch.cuda.Event()
+            ready_event.record(self.copy_stream)
+        entry = StreamedWeights(offset, params, ready_event)
+        self.staged[module] = entry
+        self.ring.append((module, entry))
+        self.streamed_bytes += self.num_bytes[module]
+        return True
+
+    def fetch(self, module, dtype=None):
+        if self.buffer is None:
+            self.buffer = torch.empty(self.capacity, dtype=torch.uint8, device=self.device)
+            self.copy_stream = torch.cuda.Stream(device=self.device)
+        if self.last_module is not None:
+            self.successor[self.last_module] = module
+        self.last_module = module
+        self.current_module = module
+
+        if module in self.staged:
+            if self.staged[module].ready_event.query():
+                self.hits += 1
+            else:
+                self.stalls += 1
+        else:
+            self.misses += 1
+            self.stage(module)
+        entry = self.staged[module]
+        entry.used = True
+        # In use again until release(): an entry staged on an earlier step still carries that step's release event
+        entry.release_event = None
+        torch.cuda.current_stream(self.device).wait_event(entry.ready_event)
+        self.prefetch(module)
+        params = entry.params
+        if dtype is not None:
+            params = {name: param.to(dtype=dtype) for name, param in params.items()}
+        return params
+
+    def prefetch(self, module):
+        successor = self.successor.get(module)
+        for _ in range(len(self.host_params)):
+            if successor is None or successor is module:
+                break
+            if successor not in self.staged and not self.stage(successor, prefetch=True):
+                break
+            successor = self.successor.get(successor)
+
+    def release(self, module):
+        # Called after the module's kernels have been queued, the region may be overwritten once they finish.
+        entry = self.staged.get(module)
+        if entry is not None:
+            entry.release_event = torch.cuda.Event()
+            entry.release_event.record(torch.cuda.current_stream(self.device))
+
+    def reset_stats(self):
+        self.hits, self.misses, self.stalls, self.streamed_bytes = 0, 0, 0, 0
+
+    def report(self):
+        total = max(self.hits + self.misses + self.stalls, 1)
+        return (f"weight streaming: {self.hits} hits, {self.misses} misses, {self.stalls} stalls "
+                f"({self.hits / total * 100:.1f}% hit rate), {self.streamed_bytes / 1024**3:.2f} GB streamed, "
+                f"buffer {self.capacity / 1024**3:.2f} GB")
@@ -1,18 +1,18 @@
 import types
 from .models.model_manager import ModelManager
-from .models.wan_video_dit import WanModel
+from .models.wan_video_dit import WanModel, ConditionCache, TimestepModulation
 from .models.wan_video_text_encoder import WanTextEncoder
 from .models.wan_video_vae import WanVideoVAE
 from .schedulers.flow_match import FlowMatchScheduler
 from .base import BasePipeline
-from .prompters import WanPrompter
+from .prompters import WanPrompter, PromptEmbeddingCache, file_fingerprint, directory_fingerprint
 import torch, os
 from einops import rearrange
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
 from typing import Optional
-from .vram_management import enable_vram_management, AutoWrappedModule, AutoWrappedLinear
+from .vram_management import enable_vram_management, list_vram_managed_modules, AutoWrappedModule, AutoWrappedLinear, AutoWrappedEmbedding, WeightStreamer, VramPlanner, measure_host_to_device_bandwidth
 from .models.wan_video_text_encoder import T5RelativeEmbedding, T5LayerNorm
 from .models.wan_video_dit import RMSNorm
 from .models.wan_video_vae import RMS_norm, CausalConv3d, Upsample
@@ -24,7 +24,9 @@ class WanVideoPipeline(BasePipeline):
         super().__init__(device=device, torch_dtype=torch_dtype)
         self.scheduler = FlowMatchScheduler(shift=5, sigma_min=0.0, extra_one_step=True)
         self.prompter = WanPrompter(tokenizer_path=tokenizer_path)
+        self.prompter.fetch_prompt_cache(None, load_text_encoder=self.load_text_encoder)
         self.text_encoder: WanTextEncoder = None
+        self.text_encoder_loader = None
         self.image_encoder = None
         self.dit: WanModel = None
         self.vae: WanVideoVAE = None
@@ -33,15 +35,21 @@ class WanVideoPipeline(BasePipeline):
         self.width_division_factor = 16
         self.use_unified_sequence_parallel = False
         self.sp_size = 1
+        self.context_caches = {}
+        self.timestep_modulation = None
+        self.weight_streamer = None
+        self.text_encoder_cast_cache_gb = 0
+        self.text_encoder_onload_device = "cpu"
+        self.distributed_vae = False
 
 
-    def enable_vram_management(self, num_persistent_param_in_dit=None):
+    def enable_text_encoder_vram_management(self):
         dtype = next(iter(self.text_encoder.parameters())).dtype
         enable_vram_management(
             self.text_encoder,
             module_map = {
                 torch.nn.Linear: AutoWrappedLinear,
-                torch.nn.Embedding: AutoWrappedModule,
+                torch.nn.Embedding: AutoWrappedEmbedding,
                 T5RelativeEmbedding: AutoWrappedModule,
                 T5LayerNorm: AutoWrappedModule,
             },
@@ -49,20 +57,78 @@ class WanVideoPipeline(BasePipeline):
                 offload_dtype=dtype,
                 offload_device="cpu",
                 onload_dtype=dtype,
-                onload_device="cpu",
+                onload_device=self.text_encoder_onload_device,
                 computation_dtype=self.torch_dtype,
                 computation_device=self.device,
             ),
+            cast_cache_bytes=int(self.text_encoder_cast_cache_gb * 1024**3),
         )
+
+
+    def plan_vram(self, budget_gb, dit_module_map, max_tokens=30000, batched_cfg=False, num_branches=3, num_inference_steps=50, stream_prefetch=None, tile_size=(30, 52), tile_stride=(15, 26), tile_batch_size=1, stream_decode_sizes=None):
+        planner = VramPlanner(int(budget_gb * 1024**3), bandwidth=measure_host_to_device_bandwidth(self.device))
+        dtype_bytes = torch.tensor([], dtype=self.torch_dtype).element_size()
+
+        # Denoising: one DiT forward at max_tokens, the text K/V caches of both prompts and the modulation tables
+        dim, ffn_dim, num_layers = self.dit.dim, self.dit.blocks[0].ffn_dim, len(self.dit.blocks)
+        batch_size = num_branches if batched_cfg else 1
+        forwards_per_step = 1 if batched_cfg else num_branches
+        reserve = batch_size * (max_tokens // self.sp_size) * (8 * dim + ffn_dim) * dtype_bytes
+        reserve += 2 * num_layers * 2 * self.prompter.text_len * dim * dtype_bytes
+        reserve += (num_layers + 1) * num_inference_steps * 6 * dim * dtype_bytes
+        # Modules that only see the conditioning inputs run once per chunk thanks to the condition caches
+        condition_modules = ("text_embedding.", "time_embedding.", "time_projection.", "audio_proj.", "audio_cond_projs.", "img_emb.")
+        condition_block_modules = ("cross_attn.k", "cross_attn.v", "cross_attn.norm_k")
+        modules, block_bytes = [], {}
+        for name, module in list_vram_managed_modules(self.dit, dit_module_map):
+            num_bytes = sum(p.numel() * p.element_size() for p in module.parameters())
+            if name.startswith(condition_modules) or (name.startswith("blocks.") and name.split(".", 2)[-1].startswith(condition_block_modules)):
+                calls_per_step = 0
+            else:
+                calls_per_step = forwards_per_step
+            modules.append((name, num_bytes, calls_per_step))
+            block = ".".join(name.split(".")[:2])
+            block_bytes[block] = block_bytes.get(block, 0) + num_bytes
+        if stream_prefetch is not None:
+            reserve += (stream_prefetch + 1) * max(block_bytes.values())
+        persistent_dit_modules = planner.plan("dit", modules, reserve)
+
+        # Prompt encoding and decoding run outside the denoising loop, with the DiT offloaded
+        if self.text_encoder is not None:
+            num_bytes = sum(p.numel() * p.element_size() for p in self.text_encoder.parameters())
+            if planner.plan_model("text_encoder", num_bytes, 256 * 1024**2):
+                self.text_encoder_onload_device = self.device
+        num_bytes = sum(p.numel() * p.element_size() for p in self.vae.parameters())
+        # one causal decoding step of a batch of tiles: 4 frames of the widest decoder stage (384 channels), a few buffers alive
+        reserve = tile_batch_size * (tile_size[0] * 8) * (tile_size[1] * 8) * 4 * 384 * dtype_bytes * 4
+        if stream_decode_sizes:
+            # the streaming decode keeps the causal caches of every tile until the last frame
+            reserve += max(self.vae.decode_cache_bytes(h, w, self.torch_dtype, True, tile_size, tile_stride, tile_batch_size) for h, w in stream_decode_sizes)
+        vae_onload_device = self.device if planner.plan_model("vae", num_bytes, reserve) else "cpu"
+        print(planner.report())
+        return persistent_dit_modules, vae_onload_device
+
+
+    def enable_vram_management(self, num_persistent_param_in_dit=None, text_encoder_cast_cache_gb=0, budget_gb=None, **plan_kwargs):
+        # text_encoder_cast_cache_gb: device memory for keeping text encoder weights cast between prompt encodes
+        # budget_gb: plan the placement for this much device memory instead of using num_persistent_param_in_dit,
+        # plan_kwargs (max_tokens, batched_cfg, num_inference_steps, stream_prefetch, stream_decode_sizes, ...) describe the workload
+        dit_module_map = {
+            torch.nn.Linear: AutoWrappedLinear,
+            torch.nn.Conv3d: AutoWrappedModule,
+            torch.nn.LayerNorm: AutoWrappedModule,
+            RMSNorm: AutoWrappedModule,
+        }
+        persistent_dit_modules, vae_onload_device = None, self.device
+        if budget_gb is not None:
+            persistent_dit_modules, vae_onload_device = self.plan_vram(budget_gb, dit_module_map, **plan_kwargs)
+        self.text_encoder_cast_cache_gb = text_encoder_cast_cache_gb
+        if self.text_encoder is not None:
+            self.enable_text_encoder_vram_management()
         dtype = next(iter(self.dit.parameters())).dtype
         enable_vram_management(
             self.dit,
-            module_map = {
-                torch.nn.Linear: AutoWrappedLinear,
-                torch.nn.Conv3d: AutoWrappedModule,
-                torch.nn.LayerNorm: AutoWrappedModule,
-                RMSNorm: AutoWrappedModule,
-            },
+            module_map = dit_module_map,
             module_config = dict(
                 offload_dtype=dtype,
                 offload_device="cpu",
@@ -80,6 +146,7 @@ class WanVideoPipeline(BasePipeline):
                 computation_dtype=self.torch_dtype,
                 computation_device=self.device,
             ),
+            persistent_modules=persistent_dit_modules,
         )
         dtype = next(iter(self.vae.parameters())).dtype
         enable_vram_management(
@@ -97,7 +164,7 @@ class WanVideoPipeline(BasePipeline):
                 offload_dtype=dtype,
                 offload_device="cpu",
                 onload_dtype=dtype,
-                onload_device=self.device,
+                onload_device=vae_onload_device,
                 computation_dtype=self.torch_dtype,
                 computation_device=self.device,
             ),
@@ -123,12 +190,32 @@ class WanVideoPipeline(BasePipeline):
         self.enable_cpu_offload()
 
 
-    def fetch_models(self, model_manager: ModelManager):
+    def enable_weight_streaming(self, prefetch=2, mapped_files=()):
+        # DiT modules beyond num_persistent_param_in_dit stream their weights through a device ring buffer
+        # holding the current block plus `prefetch` upcoming blocks, instead of being copied on the critical path.
+        # mapped_files: the shared weight store files the DiT weights are mapped from (see WeightStreamer)
+        if torch.device(self.device).type != "cuda":
+            return
+        streamer = WeightStreamer(self.device, prefetch=prefetch, mapped_files=mapped_files)
+        for name, module in self.dit.named_modules():
+            if isinstance(module, (AutoWrappedModule, AutoWrappedLinear)) and module.onload_device != module.computation_device:
+                group = ".".join(name.split(".")[:2]) if name.startswith("blocks.") else name
+                streamer.register(module, group)
+        if len(streamer.num_bytes) > 0:
+            self.weight_streamer = streamer
+            print(f"Weight streaming: {len(streamer.num_bytes)} modules, buffer {streamer.capacity / 1024**3:.2f} GB")
+
+
+    def fetch_text_encoder(self, model_manager: ModelManager):
         text_encoder_model_and_path = model_manager.fetch_model("wan_video_text_encoder", require_model_path=True)
         if text_encoder_model_and_path is not None:
             self.text_encoder, tokenizer_path = text_encoder_model_and_path
             self.prompter.fetch_models(self.text_encoder)
             self.prompter.fetch_tokenizer(os.path.join(os.path.dirname(tokenizer_path), "google/umt5-xxl"))
+
+
+    def fetch_models(self, model_manager: ModelManager):
+        self.fetch_text_encoder(model_manager)
         self.dit = model_manager.fetch_model("wan_video_dit")
         self.vae = model_manager.fetch_model("wan_video_vae")
         self.image_encoder = model_manager.fetch_model("wan_video_image_encoder")
@@ -155,9 +242,70 @@ class WanVideoPipeline(BasePipeline):
         return self.dit
 
 
+    def enable_prompt_cache(self, text_encoder_path, cache_dir=None, max_size=16, text_encoder_loader=None):
+        # Prompt embeddings are keyed by the normalised prompt together with the tokenizer, the text length,
+        # the text encoder checkpoint and the output dtype, so a stale entry can never be hit.
+        # With text_encoder_loader, the text encoder is only loaded (via a ModelManager returned by the loader)
+        # on the first prompt that misses the cache.
+        tokenizer_path = os.path.join(os.path.dirname(text_encoder_path), "google/umt5-xxl")
+        fingerprint = "|".join([
+            directory_fingerprint(tokenizer_path),
+            str(self.prompter.text_len),
+            file_fingerprint(text_encoder_path),
+            str(self.torch_dtype),
+        ])
+        self.prompter.fetch_prompt_cache(
+            PromptEmbeddingCache(fingerprint=fingerprint, cache_dir=cache_dir, max_size=max_size),
+            load_text_encoder=self.load_text_encoder,
+        )
+        self.text_encoder_loader = text_encoder_loader
+
+
+    def load_text_encoder(self):
+        if self.text_encoder is None and self.text_encoder_loader is not None:
+            print("Loading text encoder for prompts that are not in the prompt cache")
+            self.fetch_text_encoder(self.text_encoder_loader())
+            self.text_encoder.requires_grad_(False)
+            self.text_encoder.eval()
+            if self.cpu_offload:
+                self.enable_text_encoder_vram_management()
+            else:
+                self.text_encoder.to(self.device)
+        self.load_models_to_device(["text_encoder"])
+
+
     def encode_prompt(self, prompt, positive=True):
         prompt_emb = self.prompter.encode_prompt(prompt, positive=positive, device=self.device)
         return {"context": prompt_emb}
+
+
+    def batch_cfg_branches(self, branches):
+        # Stack the CFG branches along the batch dimension so that a single DiT forward serves all of them.
+        # TeaCache only looks at the timestep modulation, which is identical for every branch, so one cache decides for
+        # the whole batch. A batch holding the audio-negative branch is never skipped, as that branch never is.
+        context_keys = tuple(context_key for context_key, _, _ in branches)
+        audio_keys = tuple(audio_key for _, audio_key, _ in branches)
+        batched = {}
+        for name, value in branches[0][2].items():
+            if isinstance(value, torch.Tensor):
+                batched[name] = torch.cat([branch[name] for _, _, branch in branches])
+            else:
+                batched[name] = value
+        return context_keys, audio_keys, batched
+
+
+    def fetch_context_caches(self, prompts):
+        # Text K/V only depends on the prompt, so it is shared by all steps and chunks.
+        # Caches of prompts that are no longer in use are dropped.
+        self.context_caches = {prompt: self.context_caches.get(prompt, ConditionCache()) for prompt in prompts}
+        return self.context_caches
+    
+    
+    def fetch_timestep_modulation(self, timesteps):
+        # The modulation tables only depend on the schedule, so every chunk with the same schedule reuses them.
+        if self.timestep_modulation is None or not torch.equal(self.timestep_modulation.timesteps, timesteps):
+            self.timestep_modulation = TimestepModulation(timesteps.clone())
+        return self.timestep_modulation
     
     
     def encode_image(self, image, num_frames, height, width):
@@ -194,11 +342,60 @@ class WanVideoPipeline(BasePipeline):
         return latents
     
     
-    def decode_video(self, latents, tiled=True, tile_size=(34, 34), tile_stride=(18, 16)):
-        frames = self.vae.decode(latents, device=self.device, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
+    def encode_video_once(self, input_video, tiled=True, tile_size=(34, 34), tile_stride=(18, 16)):
+        # With the distributed VAE, only the first SP rank encodes (input_video may be None on the others)
+        # and the latents are broadcast to the group
+        if not self.distributed_vae:
+            return self.encode_video(input_video, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride).to(self.device)
+        latents, meta = None, None
+        if self.is_first_rank():
+            latents = self.encode_video(input_video, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride).to(self.device)
+            meta = (tuple(latents.shape), latents.dtype)
+        shape, dtype = self.sp_group.broadcast_object_list([meta])[0]
+        if latents is None:
+            latents = torch.empty(shape, dtype=dtype, device=self.device)
+        return self.sp_group.broadcast(latents)
+    
+    
+    def decode_video(self, latents, tiled=True, tile_size=(34, 34), tile_stride=(18, 16), tile_batch_size=1):
+        # None on the ranks other than the first with the distributed VAE
+        frames = self.vae.decode(latents, device=self.device, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride, tile_batch_size=tile_batch_size, **self.vae_shard_kwargs())
         return frames
     
     
+    def decode_video_stream(self, latents, tiled=True, tile_size=(34, 34), tile_stride=(18, 16), tile_batch_size=1, decode_session=None):
+        # Yields the decoded frames as [b, t, c, h, w] in [0, 1], a few frames at a time
+        assert decode_session is None or len(latents) == 1
+        # With the distributed VAE, the ranks other than the first yield None (tiled) or nothing (untiled)
+        streams = [self.vae.decode_stream(latent.unsqueeze(0), device=self.device, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride, tile_batch_size=tile_batch_size, session=decode_session, **self.vae_shard_kwargs()) for latent in latents]
+        for frames in zip(*streams):
+            if frames[0] is None:
+                yield None
+                continue
+            yield (torch.cat(frames).permute(0, 2, 1, 3, 4).float() + 1) / 2
+    
+    
+    def enable_distributed_vae(self):
+        # Split the VAE decode tiles across the SP group, the blended result is reduced onto the first rank
+        self.distributed_vae = self.sp_size > 1
+    
+    
+    def is_first_rank(self):
+        return self.sp_size == 1 or self.sp_group.rank_in_group == 0
+    
+    
+    def vae_shard_kwargs(self):
+        if not self.distributed_vae:
+            return {}
+        return {"tile_shard": (self.sp_group.rank_in_group, self.sp_size), "reduce_fn": self.reduce_to_first_rank}
+    
+    
+    def reduce_to_first_rank(self, tensor):
+        tensor = tensor.to(self.device)
+        torch.distributed.reduce(tensor, dst=self.sp_group.ranks[0], group=self.sp_group.device_group)
+        return tensor if self.is_first_rank() else None
+    
+    
     def prepare_unified_sequence_parallel(self):
         return {"use_unified_sequence_parallel": self.use_unified_sequence_parallel}
 
@@ -220,11 +417,19 @@ class WanVideoPipeline(BasePipeline):
         tiled=True,
         tile_size=(30, 52),
         tile_stride=(15, 26),
+        tile_batch_size=1,
         tea_cache_l1_thresh=None,
         tea_cache_model_id="",
         progress_bar_cmd=tqdm,
         return_latent=False,
+        decode_recons=True,
+        batched_cfg=False,
+        frame_consumer=None,
+        decode_session=None,
     ):
+        # frame_consumer: called with each group of decoded frames as it is produced, frames is then not returned
+        # decode_session: a VAEDecodeSession shared by the chunks of a video. Once started, the first fixed_frame latent
+        # frames are the previous chunk's last ones and are not decoded again: frames only holds the new frames.
         tiler_kwargs = {"tiled": tiled, "tile_size": tile_size, "tile_stride": tile_stride}
         # Scheduler
         self.scheduler.set_timesteps(num_inference_steps, denoising_strength=denoising_strength, shift=sigma_shift)
@@ -232,8 +437,7 @@ class WanVideoPipeline(BasePipeline):
         latents = lat.clone()
         latents = torch.randn_like(latents)
         
-        # Encode prompts
-        self.load_models_to_device(["text_encoder"])
+        # Encode prompts, the text encoder is only loaded for prompts that miss the prompt cache
         prompt_emb_posi = self.encode_prompt(prompt, positive=True)
         if cfg_scale != 1.0:
             prompt_emb_nega = self.encode_prompt(negative_prompt, positive=False)
@@ -247,6 +451,32 @@ class WanVideoPipeline(BasePipeline):
         # TeaCache
         tea_cache_posi = {"tea_cache": TeaCache(num_inference_steps, rel_l1_thresh=tea_cache_l1_thresh, model_id=tea_cache_model_id) if tea_cache_l1_thresh is not None and tea_cache_l1_thresh > 0 else None}
         tea_cache_nega = {"tea_cache": TeaCache(num_inference_steps, rel_l1_thresh=tea_cache_l1_thresh, model_id=tea_cache_model_id) if tea_cache_l1_thresh is not None and tea_cache_l1_thresh > 0 else None}
+        tea_cache_nega_audio = {"tea_cache": TeaCache(num_inference_steps, rel_l1_thresh=tea_cache_l1_thresh, model_id=tea_cache_model_id) if tea_cache_l1_thresh is not None and tea_cache_l1_thresh > 0 else None}
+
+        # CFG branches: (context cache key, audio cache key, dit kwargs), in the order posi, audio nega, text nega
+        audio_emb_uc = {key: torch.zeros_like(value) for key, value in audio_emb.items()}
+        branches = [((prompt, True), "audio", {**prompt_emb_posi, **image_emb, **audio_emb, **tea_cache_posi})]
+        if cfg_scale != 1.0:
+            if audio_cfg_scale != cfg_scale:
+                branches.append(((prompt, True), "audio_uc", {**prompt_emb_posi, **image_emb, **audio_emb_uc, **tea_cache_nega_audio}))
+            branches.append(((negative_prompt, False), "audio_uc", {**prompt_emb_nega, **image_emb, **audio_emb_uc, **tea_cache_nega}))
+        # The audio-negative branch gets a new TeaCache every step, so it is always computed
+        renewed_tea_caches = [branches[1][2]] if len(branches) == 3 and tea_cache_nega_audio["tea_cache"] is not None else []
+        if batched_cfg and len(branches) > 1:
+            branches = [self.batch_cfg_branches(branches)]
+            renewed_tea_caches = [branches[0][2]] if renewed_tea_caches else []
+        context_caches = self.fetch_context_caches([context_key for context_key, _, _ in branches])
+        # The audio projection only depends on this chunk's audio, so it is computed once per branch, not per step
+        audio_caches = {audio_key: ConditionCache() for _, audio_key, _ in branches}
+        # Same for the image latents' share of the patch embedding, which all branches of a chunk have in common
+        image_caches = {}
+        timestep_modulation = self.fetch_timestep_modulation(self.scheduler.timesteps)
+        for context_key, audio_key, branch in branches:
+            branch["context_cache"] = context_caches[context_key]
+            branch["audio_cache"] = audio_caches[audio_key]
+            if "y" in branch:
+                branch["image_cache"] = image_caches.setdefault(branch["y"].shape[0], ConditionCache())
+            branch["timestep_modulation"] = timestep_modulation
         
         # Unified Sequence Parallel
         usp_kwargs = self.prepare_unified_sequence_parallel()
@@ -256,23 +486,24 @@ class WanVideoPipeline(BasePipeline):
             if fixed_frame > 0: # new
                 latents[:, :, :fixed_frame] = lat[:, :, :fixed_frame]
             timestep = timestep.unsqueeze(0).to(dtype=self.torch_dtype, device=self.device)
+            timestep_modulation.index = progress_id
+            for branch in renewed_tea_caches:
+                branch["tea_cache"] = TeaCache(num_inference_steps, rel_l1_thresh=tea_cache_l1_thresh, model_id=tea_cache_model_id)
 
             # Inference
-            noise_pred_posi = self.dit(latents, timestep=timestep, **prompt_emb_posi, **image_emb, **audio_emb, **tea_cache_posi, **extra_input)
-            if cfg_scale != 1.0:
-                audio_emb_uc = {}
-                for key in audio_emb.keys():
-                    audio_emb_uc[key] = torch.zeros_like(audio_emb[key])
-                if audio_cfg_scale == cfg_scale:
-                    noise_pred_nega = self.dit(latents, timestep=timestep, **prompt_emb_nega, **image_emb, **audio_emb_uc, **tea_cache_nega, **extra_input)
-                    noise_pred = noise_pred_nega + cfg_scale * (noise_pred_posi - noise_pred_nega)
-                else:
-                    tea_cache_nega_audio = {"tea_cache": TeaCache(num_inference_steps, rel_l1_thresh=tea_cache_l1_thresh, model_id=tea_cache_model_id) if tea_cache_l1_thresh is not None and tea_cache_l1_thresh > 0 else None}
-                    audio_noise_pred_nega = self.dit(latents, timestep=timestep, **prompt_emb_posi, **image_emb, **audio_emb_uc, **tea_cache_nega_audio, **extra_input)
-                    text_noise_pred_nega = self.dit(latents, timestep=timestep, **prompt_emb_nega, **image_emb, **audio_emb_uc, **tea_cache_nega, **extra_input)
-                    noise_pred = text_noise_pred_nega + cfg_scale * (audio_noise_pred_nega - text_noise_pred_nega) + audio_cfg_scale * (noise_pred_posi - audio_noise_pred_nega)
+            noise_preds = []
+            for _, _, branch in branches:
+                batch_size = branch["context"].shape[0]
+                noise_pred = self.dit(latents.expand(batch_size, -1, -1, -1, -1), timestep=timestep.expand(batch_size), **branch, **extra_input)
+                noise_preds += noise_pred.chunk(batch_size)
+            if len(noise_preds) == 1:
+                noise_pred = noise_preds[0]
+            elif len(noise_preds) == 2:
+                noise_pred_posi, noise_pred_nega = noise_preds
+                noise_pred = noise_pred_nega + cfg_scale * (noise_pred_posi - noise_pred_nega)
             else:
-                noise_pred = noise_pred_posi
+                noise_pred_posi, audio_noise_pred_nega, text_noise_pred_nega = noise_preds
+                noise_pred = text_noise_pred_nega + cfg_scale * (audio_noise_pred_nega - text_noise_pred_nega) + audio_cfg_scale * (noise_pred_posi - audio_noise_pred_nega)
             # Scheduler
             latents = self.scheduler.step(noise_pred, self.scheduler.timesteps[progress_id], latents)
             
@@ -280,11 +511,29 @@ class WanVideoPipeline(BasePipeline):
             latents[:, :, :fixed_frame] = lat[:, :, :fixed_frame]
         # Decode
         self.load_models_to_device(['vae']) 
-        frames = self.decode_video(latents, **tiler_kwargs)
-        recons = self.decode_video(lat, **tiler_kwargs)
+        if decode_session is not None:
+            skip = fixed_frame if decode_session.started else 0
+            stream = self.decode_video_stream(latents[:, :, skip:], **tiler_kwargs, tile_batch_size=tile_batch_size, decode_session=decode_session.to(self.device))
+            if frame_consumer is not None:
+                for frames in stream:
+                    frame_consumer(frames)
+                frames = None
+            else:
+                frames = [frames.cpu() for frames in stream if frames is not None]
+                frames = torch.cat(frames, dim=1) if len(frames) > 0 else None
+            decode_session.to("cpu")
+        elif frame_consumer is not None:
+            for frames in self.decode_video_stream(latents, **tiler_kwargs, tile_batch_size=tile_batch_size):
+                frame_consumer(frames)
+            frames = None
+        else:
+            frames = self.decode_video(latents, **tiler_kwargs, tile_batch_size=tile_batch_size)
+            if frames is not None:
+                frames = (frames.permute(0, 2, 1, 3, 4).float() + 1) / 2
+        recons = self.decode_video(lat, **tiler_kwargs, tile_batch_size=tile_batch_size) if decode_recons else None
         self.load_models_to_device([])
-        frames = (frames.permute(0, 2, 1, 3, 4).float() + 1) / 2
-        recons = (recons.permute(0, 2, 1, 3, 4).float() + 1) / 2
+        if recons is not None:
+            recons = (recons.permute(0, 2, 1, 3, 4).float() + 1) / 2
         if return_latent:
             return frames, recons, latents
         return frames, recons
@@ -0,0 +1,62 @@
+# Compares the VAE fast mode (preallocated outputs, single-copy causal padding) with the original encode/decode loops on CPU:
+#   python scripts/benchmark_vae.py --frames 21 --height 30 --width 52
+# Sizes are in latent frames/pixels. Without --vae_path the weights are random, which is enough to compare both paths.
+import os, sys, time, argparse
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import torch
+from OmniAvatar.models.wan_video_vae import WanVideoVAE
+
+
+def parse_benchmark_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vae_path", type=str, default=None)
+    parser.add_argument("--frames", type=int, default=5)
+    parser.add_argument("--height", type=int, default=16)
+    parser.add_argument("--width", type=int, default=24)
+    parser.add_argument("--dtype", type=str, default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def timed(fn, repeat):
+    # best of `repeat` runs, and the output of the last one
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    args = parse_benchmark_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    dtype = torch.bfloat16 if args.dtype == "bf16" else torch.float32
+    vae = WanVideoVAE()
+    if args.vae_path:
+        state_dict = torch.load(args.vae_path, map_location="cpu", mmap=True, weights_only=True)
+        vae.load_state_dict(vae.state_dict_converter().from_civitai(state_dict))
+    else:
+        vae.load_state_dict({name: torch.randn_like(param) * 0.05 for name, param in vae.state_dict().items()})
+    vae = vae.to(dtype)
+
+    latents = torch.randn(1, 16, args.frames, args.height, args.width, dtype=dtype)
+    video = torch.randn(1, 3, 1 + 4 * (args.frames - 1), args.height * 8, args.width * 8, dtype=dtype).clamp_(-1, 1)
+    results = {}
+    with torch.no_grad():
+        for fast_mode in [False, True]:
+            vae.model.set_fast_mode(fast_mode)
+            decode_time, frames = timed(lambda: vae.model.decode(latents, vae.scale), args.repeat)
+            encode_time, encoded = timed(lambda: vae.model.encode(video, vae.scale), args.repeat)
+            results[fast_mode] = (frames, encoded)
+            print(f"fast_mode={fast_mode}: decode {decode_time:.2f}s, encode {encode_time:.2f}s")
+    print(f"max abs diff: decode {(results[True][0] - results[False][0]).abs().max().item():.3e}, "
+          f"encode {(results[True][1] - results[False][1]).abs().max().item():.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Checks that batched CFG (batched_cfg=True) gives the same latents as running the CFG branches one after another,
+# with a tiny random DiT on the CPU, so no checkpoint is needed:
+#   python scripts/check_batched_cfg.py --config configs/inference.yaml
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import torch
+from OmniAvatar.utils.args_config import parse_args
+args = parse_args()
+# the tiny model runs in this process only
+args.sp_size = 1
+args.use_audio = True
+
+from OmniAvatar.models.wan_video_dit import WanModel
+from OmniAvatar.wan_video import WanVideoPipeline
+
+
+def tiny_pipeline(seed=0):
+    torch.manual_seed(seed)
+    dit = WanModel(dim=96, in_dim=33, ffn_dim=128, out_dim=16, text_dim=32, freq_dim=32, eps=1e-6,
+                   patch_size=(1, 2, 2), num_heads=4, num_layers=4, has_image_input=False, audio_hidden_size=8)
+    for param in dit.parameters():
+        torch.nn.init.normal_(param, std=0.05)
+    pipe = WanVideoPipeline(device="cpu", torch_dtype=torch.float32)
+    pipe.dit = dit.eval()
+    # Random prompt embeddings instead of the text encoder, the decoded video is not compared
+    pipe.encode_prompt = lambda prompt, positive=True: {"context": torch.randn(1, 12, 32, generator=torch.Generator().manual_seed(len(prompt)))}
+    pipe.decode_video = lambda latents, **kwargs: torch.zeros(1, 3, 1, 16, 16)
+    return pipe
+
+
+def denoise(pipe, audio_cfg_scale, batched_cfg, tea_cache_l1_thresh=None, num_frames=5, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    lat = torch.randn(1, 16, num_frames, 8, 8, generator=generator)
+    image_emb = {"y": torch.randn(1, 17, num_frames, 8, 8, generator=generator)}
+    audio_emb = {"audio_emb": torch.randn(1, (num_frames - 1) * 4 + 1, 10752, generator=generator)}
+    torch.manual_seed(seed)
+    _, _, latents = pipe.log_video(lat, "a prompt", 1, image_emb, audio_emb, "a negative prompt", cfg_scale=4.5, audio_cfg_scale=audio_cfg_scale,
+                                   num_inference_steps=6, tea_cache_l1_thresh=tea_cache_l1_thresh, tea_cache_model_id="Wan2.1-T2V-1.3B",
+                                   progress_bar_cmd=lambda x, **kwargs: x, return_latent=True, decode_recons=False, batched_cfg=batched_cfg)
+    return latents
+
+
+def main():
+    pipe = tiny_pipeline()
+    failed = False
+    # (description, audio_cfg_scale, TeaCache threshold of the batched run, TeaCache threshold of the reference run)
+    cases = [
+        ("2 branches", 4.5, None, None),
+        ("3 branches", 3.0, None, None),
+        ("2 branches, TeaCache", 4.5, 0.1, 0.1),
+        # The audio-negative branch is never skipped, so a batch holding it is not either
+        ("3 branches, TeaCache", 3.0, 0.1, None),
+    ]
+    with torch.no_grad():
+        for description, audio_cfg_scale, tea_cache_batched, tea_cache_reference in cases:
+            reference = denoise(pipe, audio_cfg_scale, batched_cfg=False, tea_cache_l1_thresh=tea_cache_reference)
+            batched = denoise(pipe, audio_cfg_scale, batched_cfg=True, tea_cache_l1_thresh=tea_cache_batched)
+            diff = (batched - reference).abs().max().item()
+            failed = failed or diff > 1e-4
+            print(f"{description}: max abs diff {diff:.3e}{' FAILED' if diff > 1e-4 else ''}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Writes the pipeline weights as inference.py ends up with them (converted, cast, OmniAvatar weights or LoRA applied)
+# to `compiled_checkpoint`, so that later starts skip detection, conversion, casting and LoRA loading.
+#   python scripts/compile_checkpoint.py --config configs/inference.yaml -hp compiled_checkpoint=pretrained_models/OmniAvatar-14B-compiled
+# Add merge_lora=True to -hp to fold LoRA adapters into the base weights.
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import torch
+from OmniAvatar.utils.args_config import parse_args
+args = parse_args()
+
+from peft.tuners.lora import LoraLayer
+from OmniAvatar.utils.io_utils import load_state_dict
+from OmniAvatar.utils.lora_utils import add_lora_to_model
+from OmniAvatar.models.model_manager import ModelManager
+from OmniAvatar.models.compiled_checkpoint import CompiledCheckpoint, inference_checkpoint_key
+
+
+def merge_lora(model):
+    for name, module in list(model.named_modules()):
+        if isinstance(module, LoraLayer):
+            module.merge()
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, module.get_base_layer())
+
+
+def main():
+    assert args.compiled_checkpoint, "set compiled_checkpoint to the output directory"
+    dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(args.dtype, torch.float32)
+    ckpt_path = f'{args.exp_path}/pytorch_model.pt'
+    model_manager = ModelManager(device="cpu", infer=True)
+    model_manager.load_models([args.dit_path.split(","), args.text_encoder_path, args.vae_path], torch_dtype=dtype, device="cpu")
+    dit = model_manager.fetch_model("wan_video_dit")
+    lora_merged = False
+    if args.train_architecture == "lora":
+        # Same injection as scripts/inference.py, so that the compiled adapters match the ones it builds
+        _, unexpected_keys = add_lora_to_model(
+            dit,
+            lora_rank=args.lora_rank,
+            lora_alpha=args.lora_alpha,
+            lora_target_modules=args.lora_target_modules,
+            init_lora_weights=args.init_lora_weights,
+            pretrained_lora_path=ckpt_path,
+        )
+        if len(unexpected_keys) > 0:
+            raise ValueError(f"{ckpt_path} does not match the LoRA configuration: {len(unexpected_keys)} unexpected keys")
+        if getattr(args, "merge_lora", False):
+            merge_lora(dit)
+            lora_merged = True
+    else:
+        missing_keys, unexpected_keys = dit.load_state_dict(load_state_dict(ckpt_path, mmap=True), strict=True)
+        print(f"load from {ckpt_path}, {len(missing_keys)} missing keys, {len(unexpected_keys)} unexpected keys")
+    CompiledCheckpoint(args.compiled_checkpoint).save({
+        "wan_video_dit": (args.dit_path, dit),
+        "wan_video_text_encoder": (args.text_encoder_path, model_manager.fetch_model("wan_video_text_encoder")),
+        "wan_video_vae": (args.vae_path, model_manager.fetch_model("wan_video_vae")),
+    }, key=inference_checkpoint_key(args, dtype), lora_merged=lora_merged)
+    print(f"compiled checkpoint written to {args.compiled_checkpoint}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 import subprocess
-import os, sys
+import os, sys, gc
 from glob import glob
 from datetime import datetime
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -11,13 +11,17 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import time
 from OmniAvatar.utils.args_config import parse_args
 args = parse_args()
 
-from OmniAvatar.utils.io_utils import load_state_dict 
-from peft import LoraConfig, inject_adapter_in_model
+from OmniAvatar.utils.io_utils import load_state_dict, read_into_page_cache, init_weights_lock
+from OmniAvatar.utils.lora_utils import add_lora_to_model
+from OmniAvatar.utils.chunk_plan import plan_chunks, summarize_chunk_plan
 from OmniAvatar.models.model_manager import ModelManager
 from OmniAvatar.wan_video import WanVideoPipeline
+from OmniAvatar.models.wan_video_vae import VAEDecodeSession
 from OmniAvatar.utils.io_utils import save_video_as_grid_and_mp4
 import torch.distributed as dist
 import torchvision.transforms as TT
@@ -26,6 +30,8 @@ import torchvision.transforms as transforms
 import torch.nn.functional as F
 from OmniAvatar.utils.audio_preprocess import add_silence_to_audio_ffmpeg
 from OmniAvatar.distributed.fsdp import shard_model
+from OmniAvatar.distributed.shared_weights import SharedWeightStore
+from OmniAvatar.models.compiled_checkpoint import CompiledCheckpoint, inference_checkpoint_key
 
 def set_seed(seed: int = 42):
     random.seed(seed)
@@ -55,6 +61,30 @@ def match_size(image_size, h, w):
                 select_size = image_s
     return select_size
 
+class FrameCollector:
+    # 接收一段中逐步解码出的帧：前skip帧(与上一段重叠)丢弃，其余转为uint8放到CPU，末尾keep帧保留float作为下一段的参考
+    def __init__(self, skip, keep):
+        self.skip = skip
+        self.keep = keep
+        self.num_frames = 0
+        self.frames = []
+        self.tail = None
+
+    def __call__(self, frames):
+        # frames: [b, t, c, h, w], 0~1；分布式VAE解码时非0号rank收到的是None
+        if frames is None:
+            return
+        self.tail = frames if self.tail is None else torch.cat([self.tail, frames], dim=1)
+        # -0: would keep every frame
+        self.tail = self.tail[:, max(self.tail.shape[1] - self.keep, 0):]
+        start = max(self.skip - self.num_frames, 0)
+        self.num_frames += frames.shape[1]
+        if start < frames.shape[1]:
+            self.frames.append((255.0 * frames[:, start:]).to(torch.uint8).cpu())
+
+    def video(self):
+        return torch.cat(self.frames, dim=1)
+
 def resize_pad(image, ori_size, tgt_size):
     h, w = ori_size
     scale_ratio = max(tgt_size[0] / h, tgt_size[1] / w)
@@ -84,18 +114,40 @@ class WanInferencePipeline(nn.Module):
             self.dtype = torch.float16
         else:   
             self.dtype = torch.float32
+        if args.use_audio:
+            # 后台线程只把wav2vec的文件读进page cache，与DiT/T5/VAE的加载重叠；
+            # 模型本身在DiT/LoRA构建完之后才在主线程构建，from_pretrained会全局patch nn.Module
+            audio_encoder_prefetcher = ThreadPoolExecutor(1)
+            audio_encoder_prefetch = audio_encoder_prefetcher.submit(self.prefetch_audio_encoder)
         self.pipe = self.load_model()
         if args.i2v:
             chained_trainsforms = []
             chained_trainsforms.append(TT.ToTensor())
             self.transform = TT.Compose(chained_trainsforms)
         if args.use_audio:
-            from OmniAvatar.models.wav2vec import Wav2VecModel
-            self.wav_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
+            audio_encoder_prefetch.result()
+            audio_encoder_prefetcher.shutdown()
+            self.wav_feature_extractor, self.audio_encoder = self.load_audio_encoder()
+            self.audio_encoder = self.audio_encoder.to(device=self.device)
+            self.audio_encoder.feature_extractor._freeze_parameters()
+
+    def prefetch_audio_encoder(self):
+        # 只读文件，不构建任何模块
+        for file_path in sorted(glob(os.path.join(args.wav2vec_path, "*"))):
+            if os.path.isfile(file_path):
+                read_into_page_cache(file_path)
+
+    def load_audio_encoder(self):
+        from OmniAvatar.models.wav2vec import Wav2VecModel
+        start = time.perf_counter()
+        # from_pretrained的patch对整个进程生效，持有init_weights_lock使其不与init_weights_on_device的patch交错
+        with init_weights_lock:
+            wav_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
                     args.wav2vec_path
                 )
-            self.audio_encoder = Wav2VecModel.from_pretrained(args.wav2vec_path, local_files_only=True).to(device=self.device)
-            self.audio_encoder.feature_extractor._freeze_parameters()
+            audio_encoder = Wav2VecModel.from_pretrained(args.wav2vec_path, local_files_only=True)
+        print(f"wav2vec loaded in {time.perf_counter() - start:.1f}s")
+        return wav_feature_extractor, audio_encoder
 
     def load_model(self):
         dist.init_process_group(
@@ -116,75 +168,124 @@ class WanInferencePipeline(nn.Module):
         ckpt_path = f'{args.exp_path}/pytorch_model.pt'
         assert os.path.exists(ckpt_path), f"pytorch_model.pt not found in {args.exp_path}"
         if args.train_architecture == 'lora':
-            args.pretrained_lora_path = pretrained_lora_path = ckpt_path
-        else:
-            resume_path = ckpt_path
+            args.pretrained_lora_path = ckpt_path
         
         self.step = 0
+        # 最近一次forward的分段计划(段数、每段视频帧/latent帧/token数)
+        self.chunk_plan = None
 
         # Load models
-        model_manager = ModelManager(device="cpu", infer=True)
-        model_manager.load_models(
-            [
-                args.dit_path.split(","),
-                args.text_encoder_path,
-                args.vae_path
-            ],
-            torch_dtype=self.dtype, # You can set `torch_dtype=torch.bfloat16` to disable FP8 quantization.
-            device='cpu',
-        )
-
+        checkpoint_key = inference_checkpoint_key(args, self.dtype)
+        model_names = ["wan_video_dit", "wan_video_vae", *([] if args.lazy_text_encoder else ["wan_video_text_encoder"])]
+        self.compiled_checkpoint = None
+        if args.compiled_checkpoint:
+            # scripts/compile_checkpoint.py 预先转换好的权重，跳过检测/转换/类型转换/LoRA加载
+            if CompiledCheckpoint(args.compiled_checkpoint).up_to_date(checkpoint_key):
+                self.compiled_checkpoint = CompiledCheckpoint(args.compiled_checkpoint)
+            else:
+                print(f"{args.compiled_checkpoint} is missing or out of date, loading the original checkpoints. Rerun scripts/compile_checkpoint.py to rebuild it.")
+        shared_store = None
+        if args.shared_weights_dir:
+            shared_store = SharedWeightStore(args.shared_weights_dir, f"{checkpoint_key}-lazy" if args.lazy_text_encoder else checkpoint_key)
+        pipe = None
+        if shared_store is None or (args.local_rank == 0 and not shared_store.exists()):
+            if self.compiled_checkpoint is not None:
+                pipe = self.build_pipeline_from_compiled(self.compiled_checkpoint, model_names)
+            else:
+                model_manager = ModelManager(device="cpu", infer=True)
+                model_manager.load_models(
+                    [
+                        args.dit_path.split(","),
+                        *([] if args.lazy_text_encoder else [args.text_encoder_path]),
+                        args.vae_path
+                    ],
+                    torch_dtype=self.dtype, # You can set `torch_dtype=torch.bfloat16` to disable FP8 quantization.
+                    device='cpu',
+                    num_workers=args.load_workers,
+                    max_inflight_bytes=int(args.load_inflight_gb * 1024**3) if args.load_inflight_gb else None,
+                )
+                pipe = self.build_pipeline(model_manager, ckpt_path)
+            if shared_store is not None:
+                # 每个节点只有local rank 0读取checkpoint，并把权重写到共享内存
+                shared_store.save(self.pipeline_models(pipe))
+                # 先释放自己读取的权重再映射共享内存，避免同时占用两份内存
+                pipe = model_manager = None
+                gc.collect()
+        if shared_store is not None:
+            dist.barrier()
+            # 所有rank映射同一份共享内存中的权重，包括写入的rank自己；私有映射(写时复制)，一个rank无法改动其他rank的权重
+            pipe = self.build_pipeline_from_compiled(shared_store, model_names)
+        pipe.requires_grad_(False)
+        pipe.eval()
+        # 缓存命中时不需要运行T5；lazy_text_encoder时只在第一次未命中时才加载T5
+        pipe.enable_prompt_cache(args.text_encoder_path,
+                                 cache_dir=args.prompt_cache_dir or None,
+                                 max_size=args.prompt_cache_size,
+                                 text_encoder_loader=self.load_text_encoder if args.lazy_text_encoder else None)
+        if args.vram_budget_gb:
+            # 按显存预算自动决定哪些权重常驻显存，代替手动调num_persistent_param_in_dit
+            pipe.enable_vram_management(text_encoder_cast_cache_gb=args.text_encoder_cast_cache_gb,
+                                        budget_gb=args.vram_budget_gb,
+                                        max_tokens=args.max_tokens,
+                                        batched_cfg=args.batched_cfg,
+                                        num_inference_steps=args.num_steps,
+                                        stream_prefetch=args.stream_prefetch if args.weight_streaming else None,
+                                        tile_batch_size=args.vae_tile_batch_size,
+                                        stream_decode_sizes=[(h // 8, w // 8) for h, w in getattr(args, f'image_sizes_{args.max_hw}')] if args.stream_decode else None)
+        else:
+            pipe.enable_vram_management(num_persistent_param_in_dit=args.num_persistent_param_in_dit, text_encoder_cast_cache_gb=args.text_encoder_cast_cache_gb) # You can set `num_persistent_param_in_dit` to a small number to reduce VRAM required. 
+        if args.weight_streaming:
+            pipe.enable_weight_streaming(prefetch=args.stream_prefetch, mapped_files=[shared_store.weights_path] if shared_store is not None else ())
+        if args.distributed_vae:
+            pipe.enable_distributed_vae()
+        if args.use_fsdp:
+            shard_fn = partial(shard_model, device_id=self.device)
+            pipe.dit = shard_fn(pipe.dit)
+        return pipe
+    
+    def build_pipeline(self, model_manager, ckpt_path=None, inject_lora=True):
+        # ckpt_path为None时模型只有结构(来自预编译/共享权重)，不加载OmniAvatar的权重
         pipe = WanVideoPipeline.from_model_manager(model_manager, 
                                                 torch_dtype=self.dtype, 
                                                 device=f"cuda:{dist.get_rank()}", 
                                                 use_usp=True if args.sp_size > 1 else False,
                                                 infer=True)
-        if args.train_architecture == "lora":
+        if args.train_architecture == "lora" and inject_lora:
             print(f'Use LoRA: lora rank: {args.lora_rank}, lora alpha: {args.lora_alpha}')
-            self.add_lora_to_model(
+            add_lora_to_model(
                     pipe.denoising_model(),
                     lora_rank=args.lora_rank,
                     lora_alpha=args.lora_alpha,
                     lora_target_modules=args.lora_target_modules,
                     init_lora_weights=args.init_lora_weights,
-                    pretrained_lora_path=pretrained_lora_path,
+                    pretrained_lora_path=ckpt_path,
                 )
-        else:
-            missing_keys, unexpected_keys = pipe.denoising_model().load_state_dict(load_state_dict(resume_path), strict=True)
-            print(f"load from {resume_path}, {len(missing_keys)} missing keys, {len(unexpected_keys)} unexpected keys")
-        pipe.requires_grad_(False)
-        pipe.eval()
-        pipe.enable_vram_management(num_persistent_param_in_dit=args.num_persistent_param_in_dit) # You can set `num_persistent_param_in_dit` to a small number to reduce VRAM required. 
-        if args.use_fsdp:
-            shard_fn = partial(shard_model, device_id=self.device)
-            pipe.dit = shard_fn(pipe.dit)
+        elif ckpt_path is not None:
+            missing_keys, unexpected_keys = pipe.denoising_model().load_state_dict(load_state_dict(ckpt_path, mmap=True), strict=True)
+            print(f"load from {ckpt_path}, {len(missing_keys)} missing keys, {len(unexpected_keys)} unexpected keys")
         return pipe
-    
-    def add_lora_to_model(self, model, lora_rank=4, lora_alpha=4, lora_target_modules="q,k,v,o,ffn.0,ffn.2", init_lora_weights="kaiming", pretrained_lora_path=None, state_dict_converter=None):
-        # Add LoRA to UNet
-        self.lora_alpha = lora_alpha
-        if init_lora_weights == "kaiming":
-            init_lora_weights = True
-            
-        lora_config = LoraConfig(
-            r=lora_rank,
-            lora_alpha=lora_alpha,
-            init_lora_weights=init_lora_weights,
-            target_modules=lora_target_modules.split(","),
-        )
-        model = inject_adapter_in_model(lora_config, model)
-                
-        # Lora pretrained lora weights
-        if pretrained_lora_path is not None:
-            state_dict = load_state_dict(pretrained_lora_path)
-            if state_dict_converter is not None:
-                state_dict = state_dict_converter(state_dict)
-            missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
-            all_keys = [i for i, _ in model.named_parameters()]
-            num_updated_keys = len(all_keys) - len(missing_keys)
-            num_unexpected_keys = len(unexpected_keys)
-            print(f"{num_updated_keys} parameters are loaded from {pretrained_lora_path}. {num_unexpected_keys} parameters are unexpected.")
-    
+
+    def build_pipeline_from_compiled(self, compiled_checkpoint, model_names, shared=False):
+        model_manager = ModelManager(device="cpu", infer=True)
+        model_manager.load_compiled_checkpoint(compiled_checkpoint, model_names, load_weights=False)
+        # 未合并的LoRA要先注入adapter，再整体加载权重
+        pipe = self.build_pipeline(model_manager, inject_lora=not compiled_checkpoint.manifest()["lora_merged"])
+        compiled_checkpoint.load_weights({model_name: model for model_name, (_, model) in self.pipeline_models(pipe).items()}, shared=shared)
+        return pipe
+
+    def pipeline_models(self, pipe):
+        models = {"wan_video_dit": (args.dit_path, pipe.dit), "wan_video_vae": (args.vae_path, pipe.vae)}
+        if pipe.text_encoder is not None:
+            models["wan_video_text_encoder"] = (args.text_encoder_path, pipe.text_encoder)
+        return models
+
+    def load_text_encoder(self):
+        model_manager = ModelManager(device="cpu", infer=True)
+        if self.compiled_checkpoint is not None:
+            model_manager.load_compiled_checkpoint(self.compiled_checkpoint, ["wan_video_text_encoder"])
+        else:
+            model_manager.load_models([self.args.text_encoder_path], torch_dtype=self.dtype, device='cpu')
+        return model_manager
     
     def forward(self, prompt, 
                 image_path=None, 
@@ -242,10 +343,8 @@ class WanInferencePipeline(nn.Module):
             ori_audio_len = audio_len = math.ceil(len(input_values) / self.args.sample_rate * self.args.fps)
             input_values = input_values.unsqueeze(0)
             # padding audio
-            if audio_len < L - first_fixed_frame:
-                audio_len = audio_len + ((L - first_fixed_frame) - audio_len % (L - first_fixed_frame))
-            elif (audio_len - (L - first_fixed_frame)) % (L - fixed_frame) != 0:
-                audio_len = audio_len + ((L - fixed_frame) - (audio_len - (L - first_fixed_frame)) % (L - fixed_frame))
+            plan = plan_chunks(audio_len, L, first_fixed_frame, fixed_frame)
+            audio_len = sum(plan) - first_fixed_frame - fixed_frame * (len(plan) - 1)
             input_values = F.pad(input_values, (0, audio_len * int(self.args.sample_rate / self.args.fps) - input_values.shape[1]), mode='constant', value=0)
             with torch.no_grad():
                 hidden_states = self.audio_encoder(input_values, seq_len=audio_len, output_hidden_states=True)
@@ -257,22 +356,31 @@ class WanInferencePipeline(nn.Module):
             audio_prefix = torch.zeros_like(audio_embeddings[:first_fixed_frame])
         else:
             audio_embeddings = None
+            plan = plan_chunks(seq_len - first_fixed_frame, L, first_fixed_frame, fixed_frame)
 
         # loop
-        times = (seq_len - L + first_fixed_frame) // (L-fixed_frame) + 1
-        if times * (L-fixed_frame) + fixed_frame < seq_len:
-            times += 1
+        times = len(plan)
+        # 生成前即可查看本次的分段计划
+        self.chunk_plan = summarize_chunk_plan(plan, select_size)
+        lat_frames = self.chunk_plan["latent_frames"]
+        if dist.get_rank() == 0:
+            print(f"chunk plan: {self.chunk_plan['chunks']} chunks, video frames {plan}, latent frames {self.chunk_plan['latent_frames']}, tokens {self.chunk_plan['tokens']}")
         video = []
         image_emb = {}
         img_lat = None
         if args.i2v:
             self.pipe.load_models_to_device(['vae'])
-            img_lat = self.pipe.encode_video(image.to(dtype=self.dtype)).to(self.device)
+            img_lat = self.pipe.encode_video_once(image.to(dtype=self.dtype))
 
             msk = torch.zeros_like(img_lat.repeat(1, 1, T, 1, 1)[:,:1])
             image_cat = img_lat.repeat(1, 1, T, 1, 1)
             msk[:, :, 1:] = 1
             image_emb["y"] = torch.cat([image_cat, msk], dim=1)
+        audio_start = 0
+        # 配合latent_continuation：保留VAE的因果缓存，后续段只解码新的latent帧，不再重复解码重叠部分
+        decode_session = VAEDecodeSession() if args.latent_continuation and args.persistent_vae_cache and prefix_lat_frame > 0 else None
+        # 分布式VAE解码时只有0号rank得到解码结果
+        has_frames = not self.pipe.distributed_vae or self.pipe.is_first_rank()
         for t in range(times):
             print(f"[{t+1}/{times}]")
             audio_emb = {}
@@ -282,39 +390,54 @@ class WanInferencePipeline(nn.Module):
                 overlap = fixed_frame
                 image_emb["y"][:, -1:, :prefix_lat_frame] = 0 # 第一次推理是mask只有1，往后都是mask overlap
             prefix_overlap = (3 + overlap) // 4
+            chunk_lat_frame = lat_frames[t]
+            chunk_image_emb = {**image_emb, "y": image_emb["y"][:, :, :chunk_lat_frame]} if "y" in image_emb else image_emb
             if audio_embeddings is not None:
-                if t == 0:
-                    audio_tensor = audio_embeddings[
-                            :min(L - overlap, audio_embeddings.shape[0])
-                        ]
-                else:
-                    audio_start = L - first_fixed_frame + (t - 1) * (L - overlap)
-                    audio_tensor = audio_embeddings[
-                        audio_start: min(audio_start + L - overlap, audio_embeddings.shape[0])
-                    ]
-                    
+                audio_tensor = audio_embeddings[
+                    audio_start: min(audio_start + plan[t] - overlap, audio_embeddings.shape[0])
+                ]
+                audio_start += plan[t] - overlap
                 audio_tensor = torch.cat([audio_prefix, audio_tensor], dim=0)
                 audio_prefix = audio_tensor[-fixed_frame:]
                 audio_tensor = audio_tensor.unsqueeze(0).to(device=self.device, dtype=self.dtype)
                 audio_emb["audio_emb"] = audio_tensor
             else:
                 audio_prefix = None
-            if image is not None and img_lat is None:
+            if img_lat is None and (image is not None or not has_frames):
+                # 分布式VAE时只有0号rank有上一段的帧，由它编码后广播
                 self.pipe.load_models_to_device(['vae'])
-                img_lat = self.pipe.encode_video(image.to(dtype=self.dtype)).to(self.device)
+                img_lat = self.pipe.encode_video_once(image.to(dtype=self.dtype) if image is not None else None)
                 assert img_lat.shape[2] == prefix_overlap
-            img_lat = torch.cat([img_lat, torch.zeros_like(img_lat[:, :, :1].repeat(1, 1, T - prefix_overlap, 1, 1))], dim=2)
-            frames, _, latents = self.pipe.log_video(img_lat, prompt, prefix_overlap, image_emb, audio_emb,
+            img_lat = torch.cat([img_lat, torch.zeros_like(img_lat[:, :, :1].repeat(1, 1, chunk_lat_frame - prefix_overlap, 1, 1))], dim=2)
+            # 流式解码时边解码边转为uint8，不保留整段的float视频
+            # 使用decode_session时返回的帧已不包含重叠部分
+            skip = overlap if t > 0 and decode_session is None else 0
+            collector = FrameCollector(skip=skip, keep=fixed_frame) if args.stream_decode else None
+            frames, _, latents = self.pipe.log_video(img_lat, prompt, prefix_overlap, chunk_image_emb, audio_emb,
                                                  negative_prompt, num_inference_steps=num_steps, 
                                                  cfg_scale=guidance_scale, audio_cfg_scale=audio_scale if audio_scale is not None else guidance_scale,
-                                                 return_latent=True,
+                                                 return_latent=True, decode_recons=False, batched_cfg=args.batched_cfg, tile_batch_size=args.vae_tile_batch_size,
+                                                 frame_consumer=collector, decode_session=decode_session,
                                                  tea_cache_l1_thresh=args.tea_cache_l1_thresh,tea_cache_model_id="Wan2.1-T2V-14B")
-            img_lat = None
-            image = (frames[:, -fixed_frame:].clip(0, 1) * 2 - 1).permute(0, 2, 1, 3, 4).contiguous()
-            if t == 0:
-                video.append(frames)
+            if self.args.latent_continuation and prefix_lat_frame > 0:
+                # 直接沿用上一段的末尾latent作为下一段的前缀，省去decode→encode
+                img_lat = latents[:, :, -prefix_lat_frame:]
+            else:
+                img_lat = None
+                tail = collector.tail if collector is not None else frames
+                image = (tail[:, -fixed_frame:].clip(0, 1) * 2 - 1).permute(0, 2, 1, 3, 4).contiguous() if tail is not None else None
+            if not has_frames:
+                continue
+            if collector is not None:
+                video.append(collector.video())
             else:
-                video.append(frames[:, overlap:])
+                video.append(frames[:, skip:])
+        if self.pipe.weight_streamer is not None:
+            print(self.pipe.weight_streamer.report())
+        if self.pipe.cpu_offload:
+            print(self.pipe.residency.report())
+        if not has_frames:
+            return None
         video = torch.cat(video, dim=1)
         video = video[:, :ori_audio_len + 1]
         return video
@@ -0,0 +1,48 @@
+import unittest
+
+from OmniAvatar.utils.chunk_plan import plan_chunks, summarize_chunk_plan
+
+
+def new_frames(plan, first_fixed_frame, fixed_frame):
+    return sum(plan) - first_fixed_frame - fixed_frame * (len(plan) - 1)
+
+
+class PlanChunksTest(unittest.TestCase):
+    def test_fewer_frames_than_one_chunk(self):
+        # 20 new frames after the reference frame: one chunk, rounded up to 4n+1
+        self.assertEqual(plan_chunks(20, 81, 1, 13), [21])
+        self.assertEqual(plan_chunks(0, 81, 1, 13), [5])
+
+    def test_exact_multiple(self):
+        # the first chunk adds 80 frames, the following ones 68
+        self.assertEqual(plan_chunks(80, 81, 1, 13), [81])
+        self.assertEqual(plan_chunks(80 + 68, 81, 1, 13), [81, 81])
+        self.assertEqual(plan_chunks(80 + 2 * 68, 81, 1, 13), [81, 81, 81])
+
+    def test_first_overlap_differs(self):
+        self.assertEqual(plan_chunks(90, 81, 0, 13), [81, 25])
+        self.assertEqual(plan_chunks(100, 81, 1, 13), [81, 33])
+        self.assertEqual(plan_chunks(100, 81, 13, 1), [81, 33])
+
+    def test_plans_cover_the_frames_with_the_shortest_last_chunk(self):
+        for L in (33, 81):
+            for first_fixed_frame, fixed_frame in ((0, 0), (1, 1), (1, 13), (13, 1), (13, 13)):
+                for num_frames in range(0, 300):
+                    plan = plan_chunks(num_frames, L, first_fixed_frame, fixed_frame)
+                    self.assertTrue(all(frames % 4 == 1 and frames <= L for frames in plan), plan)
+                    self.assertTrue(all(frames == L for frames in plan[:-1]), plan)
+                    covered = new_frames(plan, first_fixed_frame, fixed_frame)
+                    self.assertGreaterEqual(covered, num_frames)
+                    # 4 frames less in the last chunk would not be enough
+                    if plan[-1] - 4 > (first_fixed_frame if len(plan) == 1 else fixed_frame):
+                        self.assertLess(covered - 4, num_frames)
+
+    def test_summary(self):
+        summary = summarize_chunk_plan([81, 33], (400, 720))
+        self.assertEqual(summary["chunks"], 2)
+        self.assertEqual(summary["latent_frames"], [21, 9])
+        self.assertEqual(summary["tokens"], [21 * 1125, 9 * 1125])
+
+
+if __name__ == "__main__":
+    unittest.main()
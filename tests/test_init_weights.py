@@ -0,0 +1,75 @@
+import threading
+import unittest
+
+import torch
+
+from OmniAvatar.utils.io_utils import init_weights_on_device, init_weights_lock
+
+
+def original_functions():
+    return torch.nn.Module.register_parameter, torch.nn.Module.register_buffer, torch.empty, torch.zeros, torch.ones, torch.full
+
+
+class InitWeightsOnDeviceTest(unittest.TestCase):
+    def test_other_threads_build_real_modules(self):
+        originals = original_functions()
+        entered, built = threading.Event(), threading.Event()
+        devices = {}
+
+        def patched_load():
+            with init_weights_on_device(include_buffers=True):
+                entered.set()
+                # stay patched until the main thread has built its module
+                built.wait()
+                devices["patched"] = torch.nn.Linear(4, 4).weight.device
+                devices["patched_zeros"] = torch.zeros(2).device
+
+        thread = threading.Thread(target=patched_load)
+        thread.start()
+        entered.wait()
+        linear = torch.nn.Linear(4, 4)
+        norm = torch.nn.BatchNorm1d(4)
+        built.set()
+        thread.join()
+
+        self.assertEqual(linear.weight.device.type, "cpu")
+        self.assertTrue(linear.weight.abs().sum() > 0)
+        self.assertEqual(norm.running_mean.device.type, "cpu")
+        self.assertEqual(torch.zeros(2).device.type, "cpu")
+        self.assertEqual(devices["patched"].type, "meta")
+        self.assertEqual(devices["patched_zeros"].type, "meta")
+        self.assertEqual(original_functions(), originals)
+
+    def test_foreign_patch_under_the_lock_is_not_stacked(self):
+        # A load that patches torch.nn.Module for the whole process (like from_pretrained) while holding the lock
+        originals = original_functions()
+        patching, entered = threading.Event(), threading.Event()
+        devices = {}
+
+        def foreign_load():
+            with init_weights_lock:
+                old_register_parameter = torch.nn.Module.register_parameter
+                def register_parameter(module, name, param):
+                    old_register_parameter(module, name, param)
+                torch.nn.Module.register_parameter = register_parameter
+                patching.set()
+                entered.wait(timeout=1)
+                devices["foreign"] = torch.nn.Linear(4, 4).weight.device
+                torch.nn.Module.register_parameter = old_register_parameter
+
+        thread = threading.Thread(target=foreign_load)
+        thread.start()
+        patching.wait()
+        # Blocks until the foreign load has restored its patch
+        with init_weights_on_device():
+            entered.set()
+            devices["main"] = torch.nn.Linear(4, 4).weight.device
+        thread.join()
+
+        self.assertEqual(devices["foreign"].type, "cpu")
+        self.assertEqual(devices["main"].type, "meta")
+        self.assertEqual(original_functions(), originals)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from OmniAvatar.distributed import shared_weights
+from OmniAvatar.distributed.shared_weights import SharedWeightStore
+
+
+def tiny_models():
+    model = torch.nn.Linear(3, 4)
+    model.init_kwargs = {"in_features": 3, "out_features": 4}
+    return {"linear": ("linear.pt", model)}
+
+
+class SharedWeightStoreTest(unittest.TestCase):
+    def test_only_unused_stores_are_removed(self):
+        root = tempfile.mkdtemp()
+        in_use = SharedWeightStore(root, "in_use")
+        in_use.save(tiny_models())
+        unused = SharedWeightStore(root, "unused")
+        unused.save(tiny_models())
+        # written by a process that has exited: nobody holds its lock any more
+        shared_weights.held_store_locks.pop(unused.lock_path).close()
+        os.makedirs(os.path.join(root, "not_a_store"))
+
+        SharedWeightStore(root, "new").save(tiny_models())
+
+        self.assertEqual(sorted(os.listdir(root)), ["in_use", "new", "not_a_store"])
+        self.assertTrue(in_use.exists())
+
+    def test_mapped_store_is_private(self):
+        root = tempfile.mkdtemp()
+        models = tiny_models()
+        store = SharedWeightStore(root, "key")
+        store.save(models)
+        first, second = torch.nn.Linear(3, 4), torch.nn.Linear(3, 4)
+        store.load_weights({"linear": first})
+        store.load_weights({"linear": second})
+        with torch.no_grad():
+            first.weight.add_(1)
+        self.assertTrue(torch.equal(second.weight, models["linear"][1].weight))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import random
+import unittest
+from contextlib import nullcontext
+from unittest import mock
+
+import torch
+
+from OmniAvatar.vram_management.streaming import WeightStreamer
+
+
+class FakeEvent:
+    def record(self, stream=None):
+        pass
+
+    def query(self):
+        return True
+
+
+class FakeStream:
+    def wait_event(self, event):
+        pass
+
+
+def make_streamer(sizes, capacity, prefetch):
+    # The streamer's bookkeeping without CUDA: the ring buffer lives on the CPU and copies are synchronous
+    streamer = WeightStreamer("cpu", prefetch=prefetch, alignment=4)
+    modules = []
+    for i, size in enumerate(sizes):
+        module = torch.nn.Module()
+        streamer.host_params[module] = {"weight": torch.randint(0, 255, (size,), dtype=torch.uint8)}
+        streamer.num_bytes[module] = streamer.aligned(size)
+        modules.append(module)
+    streamer.capacity = capacity
+    streamer.buffer = torch.zeros(capacity, dtype=torch.uint8)
+    streamer.copy_stream = FakeStream()
+    return streamer, modules
+
+
+class WeightStreamerAllocatorTest(unittest.TestCase):
+    def test_fetched_weights_are_never_overwritten(self):
+        rng = random.Random(1)
+        patches = [
+            mock.patch.object(torch.cuda, "Event", FakeEvent),
+            mock.patch.object(torch.cuda, "stream", lambda stream: nullcontext()),
+            mock.patch.object(torch.cuda, "current_stream", lambda device=None: FakeStream()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        for _ in range(3000):
+            sizes = [rng.randint(1, 64) for _ in range(rng.randint(2, 12))]
+            min_capacity = 2 * ((max(sizes) + 3) // 4 * 4)
+            capacity = rng.randint(min_capacity, max(min_capacity, sum(sizes) + 8))
+            streamer, modules = make_streamer(sizes, capacity, prefetch=rng.randint(1, 4))
+            order = list(modules)
+            for step in range(6):
+                if step == 3:
+                    # the execution order may change, e.g. a module is skipped
+                    order = [module for module in order if rng.random() > 0.2] or modules[:1]
+                for module in order:
+                    params = streamer.fetch(module)
+                    self.assertIn(module, streamer.staged)
+                    self.assertTrue(torch.equal(params["weight"], streamer.host_params[module]["weight"]))
+                    streamer.release(module)
+                    # staged regions never overlap
+                    regions = sorted((entry.offset, entry.offset + streamer.num_bytes[m]) for m, entry in streamer.ring)
+                    for (_, end), (begin, _) in zip(regions, regions[1:]):
+                        self.assertLessEqual(end, begin)
+
+
+if __name__ == "__main__":
+    unittest.main()